@@ -1,520 +1,3312 @@
-import argparse
-import os
-import re
-import string
-import json
-import glob
-import requests
-import shutil
-import logging
-import sys
-
-import FileRenamerConfig as config
-
-
-class SkipDryRunFilter(logging.Filter):
-    def filter(self, record):
-        return not getattr(record, 'dryrun', False)
-
-
-class Summary:
-    def __init__(self):
-        self.total_files = 0
-        self.renamed = 0
-        self.skipped = 0
-        self.errors = 0
-
-    def report(self):
-        logging.info("=== Summary Report ===")
-        logging.info(f"Total files processed: {self.total_files}")
-        logging.info(f"Files renamed:         {self.renamed}")
-        logging.info(f"Files skipped:         {self.skipped}")
-        logging.info(f"Errors encountered:    {self.errors}")
-
-
-def parse_args():
-    parser = argparse.ArgumentParser(description="Rename files from Stash metadata and create accompanying NFO files")
-    parser.add_argument("--indir", default="./", help="Directory containing files to process")
-    parser.add_argument("--outdir", default="./", help="Base output directory for renamed files")  # ✅ Add this line
-    parser.add_argument("--mask", default="*", help="File mask to process")
-    parser.add_argument("--extra", action="store_true", help="Also write JPG and NFO files")
-    parser.add_argument("--dryrun", action="store_true", help="Preview changes without moving files")
-    parser.add_argument("--verbose", action="store_true", help="Enable verbose logging")
-    parser.add_argument("--sceneroot", default=config.scene_root, help="Root directory for scene files")
-    parser.add_argument("--galleryroot", default=config.gallery_root, help="Root directory for gallery files")
-    return parser.parse_args()
-
-
-def ensure_directories(args):
-    for path in [args.sceneroot, args.galleryroot]:
-        if not os.path.exists(path):
-            try:
-                os.makedirs(path)
-                logging.info(f"Created missing directory: {path}")
-            except Exception as e:
-                logging.error(f"Failed to create directory {path}: {e}")
-
-
-def setup_logging(verbose):
-    level = logging.DEBUG if verbose else logging.INFO
-    handlers = [logging.StreamHandler(sys.stdout)]
-
-    if config.logfile_path:
-        try:
-            file_handler = logging.FileHandler(config.logfile_path, mode='a', encoding='utf-8')
-            file_handler.setLevel(logging.INFO)
-            file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
-
-            # ⛔️ Skip dryrun entries in the file log
-            file_handler.addFilter(SkipDryRunFilter())
-
-            handlers.append(file_handler)
-        except Exception as e:
-            print(f"⚠️ Failed to set up file logging: {e}")
-
-    logging.basicConfig(level=level, format='%(levelname)s: %(message)s', handlers=handlers)
-
-
-def validate_config():
-    required = [config.server_ip, config.server_port]
-    if not all(required):
-        logging.error("Missing required config values: server_ip or server_port")
-        sys.exit(1)
-
-    config.server = build_server_url()
-
-
-def build_server_url():
-    protocol = "https" if config.use_https else "http"
-    return f"{protocol}://{config.server_ip}:{config.server_port}"
-
-
-def set_auth(server):
-    try:
-        r = requests.get(f"{server}/playground", verify=not config.ignore_ssl_warnings)
-        if r.history and r.history[-1].status_code == 302:
-            config.auth = "jwt"
-            jwt_auth(server)
-        elif r.status_code == 200:
-            config.auth = "none"
-        else:
-            config.auth = "basic"
-    except requests.RequestException as e:
-        logging.error(f"Failed to connect to server: {e}")
-        sys.exit(1)
-
-
-def jwt_auth(server):
-    try:
-        response = requests.post(f"{server}/login", data={'username': config.username, 'password': config.password}, verify=not config.ignore_ssl_warnings)
-        token = response.cookies.get('session')
-        if not token:
-            logging.error("JWT authentication failed")
-            sys.exit(1)
-        config.headers['Authorization'] = f"Bearer {token}"
-    except requests.RequestException as e:
-        logging.error(f"JWT auth error: {e}")
-        sys.exit(1)
-
-
-def get_file_list(indir, mask):
-    pattern = os.path.join(indir, mask)
-    return [f for f in glob.glob(pattern) if os.path.isfile(f)]
-
-
-def call_graphql(query):
-    try:
-        response = requests.post(f"{config.server}/graphql", json={'query': query}, headers=config.headers, verify=not config.ignore_ssl_warnings)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        logging.error(f"GraphQL query failed: {e}")
-        return {}
-
-
-def fetch_metadata(basename):
-    query = config.file_query.replace("<FILENAME>", basename)
-    result = call_graphql(query)
-    if not result or not isinstance(result, dict):
-        logging.error(f"No result returned for query: {basename}")
-        return {}
-
-    logging.debug(f"GraphQL response for {basename}:\n{json.dumps(result, indent=2)}")
-    return result
-
-
-def should_process(scene_data):
-    return scene_data and scene_data.get("studio")
-
-
-def get_parental_path(studioid):
-    basequery = """
-        query {
-          findStudio(id: "<STUDIONUM>") {
-            id
-            name
-            parent_studio {
-              id
-            }
-          }
-        }
-    """
-    studiolist = {}
-    counter = 0
-
-    while studioid:
-        query = basequery.replace("<STUDIONUM>", studioid)
-        result = call_graphql(query)
-
-        if not isinstance(result, dict):
-            logging.error(f"Invalid response type for studio ID {studioid}: {type(result)}")
-            break
-
-        data = result.get('data')
-        if not isinstance(data, dict):
-            logging.error(f"No 'data' field in response for studio ID {studioid}")
-            break
-
-        studio = data.get('findStudio')
-        if not isinstance(studio, dict):
-            logging.warning(f"Studio ID {studioid} not found or returned null.")
-            break
-
-        name = studio.get('name', f"UnknownStudio_{studioid}")
-        studiolist[counter] = name
-
-        parent = studio.get('parent_studio', None)
-        if parent is None:
-            logging.debug(f"Studio ID {studioid} has no parent. Ending path trace.")
-            break
-
-        if not isinstance(parent, dict):
-            logging.warning(f"Unexpected parent_studio format for studio ID {studioid}: {type(parent)}")
-            break
-
-        studioid = parent.get('id')
-        if not studioid:
-            logging.debug("Parent studio has no ID. Ending path trace.")
-            break
-
-        counter += 1
-
-    if not studiolist:
-        studiolist[0] = "Uncategorized"
-
-    return studiolist
-
-
-def truncate_string(s, max_length=50):
-    if len(s) <= max_length:
-        return s
-    for sep in ['-', '_']:
-        pos = s[:max_length].rfind(sep)
-        if pos != -1:
-            return s[:pos]
-    return s[:max_length]
-
-
-def build_output_path(filedata, args):
-    path = args.outdir
-    if ".zip" in filedata['extension'].lower():
-        path = args.galleryroot
-    else:
-        path = args.sceneroot
-
-    studiolist = filedata.get('studiolist')
-    if not isinstance(studiolist, dict) or not studiolist:
-        logging.warning(f"No valid studio path found for {filedata['filename']}. Using fallback.")
-        studiolist = {0: "Uncategorized"}
-
-    for i in reversed(sorted(studiolist.keys())):
-        studiopath = re.sub(r'[^-a-zA-Z0-9_.() ]+', '', studiolist[i]).strip()
-        path = os.path.join(path, studiopath.title())
-
-    try:
-        os.makedirs(path, exist_ok=True)
-    except Exception as e:
-        logging.error(f"Failed to create directory {path}: {e}")
-        path = args.outdir  # fallback to base output
-
-    return path
-
-
-def normalize_string(s):
-    return re.sub(r'[^a-zA-Z0-9]+', '', s).lower()
-
-
-def format_filename(filedata, args):
-    data = filedata['jsondata']
-
-    # Performers
-    performers = ", ".join([p['name'] for p in data.get('performers', [])[:3]])
-    performer_str = f"({performers})" if performers else ""
-
-    # Tags
-    tags = ", ".join([t['name'] for t in data.get('tags', [])])
-
-    # Dimensions
-    file_info = data.get('files', [{}])[0]
-    width = file_info.get('width')
-    height = file_info.get('height')
-    dimensions = f"[{width}x{height}]" if width and height else ""
-
-    # Title and Code
-    title = re.sub(r'[^-a-zA-Z0-9_.()\[\]\' ,]+', ' ', data.get('title', 'Untitled')).strip().title()
-    title = truncate_string(title, 100)
-    code = truncate_string(data.get('code', ''), 50)
-
-    normalized_title = normalize_string(title)
-    normalized_code = normalize_string(code)
-
-    # Check for fallback ID in original filename
-    fallback_id_match = re.search(r'\[(\d+)\]', filedata['basename'])
-    fallback_id = fallback_id_match.group(1) if fallback_id_match else ""
-    # Determine name format
-    if normalized_title == normalized_code:
-        if args.dryrun:
-            if fallback_id:
-                logging.info(f"[DRY-RUN] STUDIOID removed from filename due to equality with TITLE in Stash data for: {filedata['filename']}.  Using Fallback ID of [{fallback_id}] Instead.", extra={'dryrun': True})
-            else:
-                logging.info(f"[DRY-RUN] STUDIOID removed from filename due to equality with TITLE in Stash data for: {filedata['filename']}", extra={'dryrun': True})
-        else:
-            if fallback_id:
-                logging.info(f"STUDIOID removed from filename due to equality with TITLE in Stash data for: {filedata['filename']}.  Using Fallback ID of [{fallback_id}] Instead.")
-            else:
-                logging.info(f"STUDIOID removed from filename due to equality with TITLE in Stash data for: {filedata['filename']}")
-        if fallback_id:
-            name = config.name_format.replace("<STUDIOID>", fallback_id)
-        else:
-            name = config.name_format.replace(" [<STUDIOID>]", "")
-    else:
-        name = config.name_format.replace("<STUDIOID>", code)
-
-    # Studio and Parent Studio
-    studio = data.get('studio')
-    studio_name = studio.get('name', 'UnknownStudio') if studio else 'UnknownStudio'
-
-    parent = studio.get('parent_studio') if studio else None
-    parent_name = parent.get('name', studio_name) if isinstance(parent, dict) else studio_name
-
-    # Build filename
-    name = name.replace("<STUDIO>", studio_name.title())
-    name = name.replace("<PARENT>", parent_name.title())
-    name = name.replace("<TITLE>", string.capwords(title))
-    name = name.replace("<ID>", str(data.get('id', '')))
-    name = name.replace("<DATE>", data.get('date', ''))
-    name = name.replace("<PERFORMERS>", performer_str)
-    name = name.replace("<TAGS>", tags)
-    name = name.replace("<DIMENSIONS>", dimensions)
-
-    # Final cleanup: sanitize filename
-    name = re.sub(r'[<>:"/\\|?*\x00-\x1F]', '', name)  # Remove illegal filesystem characters
-    name = re.sub(r'\s+', ' ', name).strip()           # Collapse whitespace
-    name = re.sub(r'[^\w\-.,()\[\]\' ]+', '', name)    # Remove any remaining unsafe characters
-
-    return name
-
-
-def move_file(filedata, targetname, dry_run):
-    fullpath = filedata['output_path']
-    extension = filedata['extension']
-    target = os.path.join(fullpath, targetname + extension)
-
-    if dry_run:
-        logging.info(f"[DRY-RUN] Would move: {filedata['filename']} → {target}", extra={'dryrun': True})
-    else:
-        if os.path.exists(target):
-            logging.warning(f"Target file already exists: {target}. Skipping move.")
-            return None  # or return original path if you prefer
-
-        logging.info(f"Moving: {filedata['filename']} → {target}")
-        shutil.move(filedata['filename'], target)
-
-    return os.path.join(fullpath, targetname)
-
-
-def get_image(filedata):
-    url = filedata['jsondata'].get('paths', {}).get('screenshot')
-    if url:
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            with open(filedata['fullpathname'] + ".jpg", "wb") as f:
-                f.write(response.content)
-        except requests.RequestException as e:
-            logging.warning(f"Image download failed: {e}")
-    else:
-        logging.info(f"No screenshot for {filedata['filename']}")
-
-
-def generate_nfo(scene):
-    tags = ""
-    if config.create_collection_tags:
-        parent = scene['studio'].get('parent_studio', {}).get('name', scene['studio']['name'])
-        tags += f"<tag>Site: {scene['studio']['name']}</tag>\n"
-        tags += f"<tag>Studio: {parent}</tag>\n"
-
-    genres = "\n".join([
-        f"<genre>{t['name']}</genre>"
-        for t in scene['tags']
-        if t['id'] not in config.ignore_tags and "ambiguous" not in t['name'].lower()
-    ])
-
-    performers = "\n".join([
-        f"""    <actor>
-        <name>{p['name']}</name>
-        <role></role>
-        <order>{i}</order>
-        <thumb>{p['image_path']}</thumb>
-    </actor>""" for i, p in enumerate(scene['performers'])
-    ])
-
-    thumbs = f"<thumb aspect='poster'>{scene['paths']['screenshot']}</thumb>"
-    fanart = f"<fanart><thumb>{scene['paths']['screenshot']}</thumb></fanart>"
-
-    rating = str(int(scene['rating']) * 2) if scene.get('rating') else ""
-    date = scene.get('date', "")
-    studio = scene['studio']['name']
-    title = scene.get('title', "Untitled")
-    plot = scene.get('details', "")
-    scene_id = scene['id']
-
-    return f"""<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
-<movie>
-    <title>{title}</title>
-    <userrating>{rating}</userrating>
-    <plot>{plot}</plot>
-    <uniqueid type="stash">{scene_id}</uniqueid>
-    {tags}
-    <premiered>{date}</premiered>
-    <studio>{studio}</studio>
-    {performers}
-    {thumbs}
-    {fanart}
-    {genres}
-</movie>
-"""
-
-
-def write_file(filename, content, use_utf=True):
-    encoding = "utf-8-sig" if use_utf else None
-    try:
-        with open(filename, "w", encoding=encoding) as f:
-            f.write(content)
-        logging.info(f"Wrote file: {filename}")
-    except Exception as e:
-        logging.error(f"Failed to write file {filename}: {e}")
-
-
-def process_file(file, args):
-    safe = ']'
-    unsafe = ''.join(c for c in string.punctuation if c not in safe)
-    basename = os.path.splitext(os.path.basename(file))[0].strip().rstrip(unsafe)
-    part_match = re.search(r'(.*)-\d+$', basename)
-    if part_match and ".zip" in file:
-        basename = part_match.group(1)
-
-    logging.debug(f"Querying for: {basename}")
-    metadata = fetch_metadata(basename)
-
-    if not isinstance(metadata, dict):
-        logging.error(f"Metadata is not a dictionary for {basename}")
-        return "error"
-
-    data = metadata.get('data')
-    if not isinstance(data, dict):
-        logging.error(f"No 'data' field in GraphQL response for {basename}")
-        return "error"
-
-    find_scenes = data.get('findScenes')
-    if not isinstance(find_scenes, dict):
-        logging.error(f"'findScenes' field missing or invalid for {basename}")
-        return "error"
-
-    scenes = find_scenes.get('scenes')
-    if not isinstance(scenes, list) or not scenes:
-        logging.warning(f"No scenes found for {basename}")
-        return "skipped"
-
-    scene = scenes[0]
-
-    if not should_process(scene):
-        logging.warning(f"Scene data missing studio info: {basename}")
-        return "skipped"
-
-    if not isinstance(scene.get('files'), list) or len(scene['files']) != 1:
-        logging.warning(f"Multiple or missing files in Stash for {file}. Skipping.")
-        return "skipped"
-
-    studio = scene.get('studio')
-    studio_id = studio.get('id') if isinstance(studio, dict) else None
-    if not studio_id:
-        logging.warning(f"No studio ID found for {basename}. Skipping.")
-        return "skipped"
-
-    try:
-        filedata = {
-            'jsondata': scene,
-            'filename': file,
-            'basename': basename,
-            'extension': os.path.splitext(file)[-1],
-            'studiolist': get_parental_path(studio_id)
-        }
-
-        filedata['output_path'] = build_output_path(filedata, args)
-        targetname = format_filename(filedata, args)
-        filedata['fullpathname'] = move_file(filedata, targetname, args.dryrun)
-        if not filedata['fullpathname']:
-
-            if args.dryrun:
-                logging.info(f"[DRY-RUN] File \'{filedata['filename']}\' not moved due to existing target: {targetname}", extra={'dryrun': True})
-            else:
-                logging.warning(f"File \'{filedata['filename']}\' not moved due to existing target: {targetname}")
-            return "skipped"
-
-        if args.extra:
-            get_image(filedata)
-            nfo = generate_nfo(scene)
-            write_file(filedata['fullpathname'] + ".nfo", nfo, use_utf=True)
-
-        return "renamed"
-
-    except Exception as e:
-        logging.error(f"Unhandled error processing {file}: {e}")
-        logging.debug(f"Scene data: {json.dumps(scene, indent=2)}")
-        return "error"
-
-
-def main():
-    args = parse_args()
-    setup_logging(args.verbose)
-
-    validate_config()  # ✅ This must be called before anything uses config.server
-    ensure_directories(args)
-
-    summary = Summary()
-    files = get_file_list(args.indir, args.mask)
-
-    if not files:
-        logging.warning("No files found to process.")
-        return
-
-    for file in files:
-        summary.total_files += 1
-        try:
-            result = process_file(file, args)
-            if result == "renamed":
-                summary.renamed += 1
-            elif result == "skipped":
-                summary.skipped += 1
-            else:
-                summary.errors += 1
-        except Exception as e:
-            logging.error(f"Unhandled error processing {file}: {e}")
-            summary.errors += 1
-
-    summary.report()
-
-
-if __name__ == "__main__":
-    main()
+import argparse
+import atexit
+import contextlib
+import cProfile
+import errno
+import io
+import os
+import re
+import string
+import json
+import fnmatch
+import hashlib
+import itertools
+import queue
+import random
+import select
+import socket
+import struct
+import shutil
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import FileRenamerConfig as config
+
+
+class SkipDryRunFilter(logging.Filter):
+    def filter(self, record):
+        return not getattr(record, 'dryrun', False)
+
+
+class SkipAuditFilter(logging.Filter):
+    def filter(self, record):
+        return not hasattr(record, 'audit')
+
+
+class AuditOnlyFilter(logging.Filter):
+    def filter(self, record):
+        return hasattr(record, 'audit')
+
+
+class AuditFormatter(logging.Formatter):
+    # One JSON object per line: what happened to which file, enough to put it back (see --undo)
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), 'event': record.getMessage()}
+        entry.update(record.audit)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Hands records over as they are, so %-style arguments are formatted on the listener thread, not the workers
+    def prepare(self, record):
+        return record
+
+
+class BatchedFileHandler(logging.FileHandler):
+    # Leaves flushing to the listener, so lines reach a log file on a network share in batches
+    def flush(self):
+        pass
+
+    def sync(self):
+        super().flush()
+
+    def close(self):
+        self.sync()
+        super().close()
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    # Flushes the handlers when the queue runs dry, or every log_flush_seconds while it doesn't
+    def __init__(self, queue, *handlers):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.flushed = time.monotonic()
+
+    def dequeue(self, block):
+        if time.monotonic() - self.flushed > config.log_flush_seconds:
+            self.flush()
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            self.flush()
+        return self.queue.get(block)
+
+    def flush(self):
+        for handler in self.handlers:
+            getattr(handler, 'sync', handler.flush)()
+        self.flushed = time.monotonic()
+
+
+log_context = threading.local()
+
+
+class FileContextFilter(logging.Filter):
+    # Prefixes log lines with the file a worker thread is currently handling
+    def filter(self, record):
+        name = getattr(log_context, 'file', None)
+        record.file_tag = f"[{name}] " if name else ""
+        return True
+
+
+class file_context:
+    def __init__(self, file):
+        self.name = os.path.basename(file)
+
+    def __enter__(self):
+        self.previous = getattr(log_context, 'file', None)
+        log_context.file = self.name
+
+    def __exit__(self, *exc):
+        log_context.file = self.previous
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}  # stage -> [seconds, ...]
+        self.bytes = {}    # kind -> total bytes
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timings.setdefault(name, []).append(elapsed)
+
+    def add_bytes(self, kind, count):
+        with self.lock:
+            self.bytes[kind] = self.bytes.get(kind, 0) + count
+
+    def stats(self):
+        stats = {}
+        with self.lock:
+            for name, samples in self.timings.items():
+                ordered = sorted(samples)
+                stats[name] = {
+                    'count': len(ordered),
+                    'total': sum(ordered),
+                    'p50': ordered[int(0.50 * (len(ordered) - 1))],
+                    'p95': ordered[int(0.95 * (len(ordered) - 1))],
+                    'max': ordered[-1],
+                }
+        return stats
+
+    def write_json(self, path, summary, elapsed):
+        report = {
+            'elapsed': elapsed,
+            'summary': summary.to_dict(),
+            'stages': self.stats(),
+            'bytes': dict(self.bytes),
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    def write_prometheus(self, path, summary, elapsed):
+        lines = [
+            "# TYPE filerenamer_stage_seconds summary",
+        ]
+        for name, stat in sorted(self.stats().items()):
+            lines.append(f'filerenamer_stage_seconds{{stage="{name}",quantile="0.5"}} {stat["p50"]:.6f}')
+            lines.append(f'filerenamer_stage_seconds{{stage="{name}",quantile="0.95"}} {stat["p95"]:.6f}')
+            lines.append(f'filerenamer_stage_seconds_sum{{stage="{name}"}} {stat["total"]:.6f}')
+            lines.append(f'filerenamer_stage_seconds_count{{stage="{name}"}} {stat["count"]}')
+        lines.append("# TYPE filerenamer_bytes_total counter")
+        for kind, count in sorted(self.bytes.items()):
+            lines.append(f'filerenamer_bytes_total{{kind="{kind}"}} {count}')
+        lines.append("# TYPE filerenamer_files_total counter")
+        for result, count in summary.to_dict().items():
+            lines.append(f'filerenamer_files_total{{result="{result}"}} {count}')
+        lines.append("# TYPE filerenamer_run_seconds gauge")
+        lines.append(f"filerenamer_run_seconds {elapsed:.3f}")
+
+        # Written to a temp file and renamed so a textfile collector never reads half a report
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+metrics = Metrics()
+
+
+class Summary:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = None  # file -> result, when the caller wants per-file outcomes
+        self.total_files = 0
+        self.renamed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.planned = 0
+        self.duplicates = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def record(self, result, file=None):
+        with self.lock:
+            if self.results is not None and file is not None:
+                self.results[file] = result
+            self.total_files += 1
+            if result == "renamed":
+                self.renamed += 1
+            elif result in ("skipped", "missing"):
+                self.skipped += 1
+            elif result == "planned":
+                self.planned += 1
+            elif result == "duplicate":
+                self.duplicates += 1
+            else:
+                self.errors += 1
+
+    def to_dict(self):
+        return {
+            'total_files': self.total_files,
+            'renamed': self.renamed,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'planned': self.planned,
+            'duplicates': self.duplicates,
+            'connections_opened': self.connections_opened,
+            'connections_reused': self.connections_reused,
+        }
+
+    def merge(self, counts):
+        with self.lock:
+            for key, value in counts.items():
+                if isinstance(getattr(self, key, None), int):
+                    setattr(self, key, getattr(self, key) + value)
+
+    def report(self):
+        logging.info("=== Summary Report ===")
+        logging.info(f"Total files processed: {self.total_files}")
+        logging.info(f"Files renamed:         {self.renamed}")
+        logging.info(f"Files skipped:         {self.skipped}")
+        logging.info(f"Errors encountered:    {self.errors}")
+        if self.planned:
+            logging.info(f"Files planned:         {self.planned}")
+        if self.duplicates:
+            logging.info(f"Duplicates removed:    {self.duplicates}")
+        logging.info(f"HTTP connections:      {self.connections_opened} opened, {self.connections_reused} reused")
+
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n, got '{value}'")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard must be between 1/{count} and {count}/{count}")
+    return index, count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rename files from Stash metadata and create accompanying NFO files")
+    parser.add_argument("--indir", default="./", help="Directory containing files to process")
+    parser.add_argument("--outdir", default="./", help="Base output directory for renamed files")  # ✅ Add this line
+    parser.add_argument("--mask", nargs="+", default=["*"], help="File mask(s) to process")
+    parser.add_argument("--exclude", nargs="+", default=[], help="File mask(s) to leave alone")
+    parser.add_argument("--recursive", action="store_true", help="Also process files in subdirectories of --indir")
+    parser.add_argument("--min-size", type=parse_size, default=0, help="Ignore files smaller than this (e.g. 500K, 100M, 2G)")
+    parser.add_argument("--min-age", type=float, default=0, help="Ignore files modified less than this many seconds ago")
+    parser.add_argument("--extra", action="store_true", help="Also write JPG and NFO files")
+    parser.add_argument("--dryrun", action="store_true", help="Preview changes without moving files")
+    parser.add_argument("--plan", help="Look everything up and write the planned moves to this JSONL file instead of moving anything")
+    parser.add_argument("--apply", help="Carry out the moves in a file written by --plan, without querying Stash")
+    parser.add_argument("--audit-log", default=config.audit_log_path, help="Append a JSON line for every file moved or written to this file (empty to disable)")
+    parser.add_argument("--undo", help="Move files back and remove the sidecars created, as recorded in an --audit-log file, newest first")
+    parser.add_argument("--journal", help="Journal of per-file progress used by --resume (empty to disable; default: journal_path, named after --indir, --shard and --apply)")
+    parser.add_argument("--shard", type=parse_shard, help="Only handle shard i of n (e.g. 2/3) of the files, for splitting a run over several machines")
+    parser.add_argument("--summary-out", help="Write this run's summary counts as JSON to this file")
+    parser.add_argument("--merge-summaries", nargs="+", help="Print one combined summary from --summary-out files and exit")
+    parser.add_argument("--watch", action="store_true", help="Keep running and rename files as they arrive in --indir")
+    parser.add_argument("--resume", action="store_true", help="Finish the work recorded in the journal of an interrupted run before scanning --indir or applying --apply")
+    parser.add_argument("--verbose", action="store_true", help="Enable verbose logging")
+    parser.add_argument("--report", help="Write per-stage timings and the summary as JSON to this file")
+    parser.add_argument("--prometheus", help="Write per-stage timings in Prometheus textfile format to this file")
+    parser.add_argument("--profile", help="Write a cProfile dump of the run to this file")
+    parser.add_argument("--sceneroot", default=config.scene_root, help="Root directory for scene files")
+    parser.add_argument("--galleryroot", default=config.gallery_root, help="Root directory for gallery files")
+    parser.add_argument("--batch-size", type=int, default=config.batch_size, help="Number of files to look up per GraphQL request (1 disables batching)")
+    parser.add_argument("--workers", type=int, default=config.workers, help="Threads used for Stash lookups")
+    parser.add_argument("--io-workers", type=int, default=config.io_workers, help="Threads used for moves, downloads and NFO writes")
+    parser.add_argument("--cache", default=config.cache_path, help="SQLite file caching Stash lookups between runs (empty to disable)")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached lookups and re-query Stash (results are still cached)")
+    parser.add_argument("--cache-only", action="store_true", help="Only use cached lookups, never contact Stash")
+    parser.add_argument("--match", choices=["filename", "oshash"], default=config.match_mode, help="Match files to scenes by filename or by oshash fingerprint")
+    parser.add_argument("--index", action="store_true", help="Match files against a local index of all Stash scene filenames instead of one path search per file")
+    parser.add_argument("--index-file", default=config.scene_index_path, help="Where the scene filename index is kept between runs (empty to rebuild every run)")
+    parser.add_argument("--duplicates", choices=["quarantine", "delete"], default=config.duplicate_action or None,
+                        help="Quarantine or delete files already in the library instead of moving them, and give different files with a taken name a suffix")
+    parser.add_argument("--quarantine", default=config.duplicate_quarantine, help="Directory --duplicates quarantine moves duplicates to")
+    parser.add_argument("--library-index", default=config.library_index_path, help="Where sizes and sampled hashes of the library files are kept between runs (empty to rehash every run)")
+    args = parser.parse_args()
+    if args.plan and args.apply:
+        parser.error("--plan and --apply can't be used together")
+    if args.watch and (args.plan or args.apply):
+        parser.error("--watch can't be combined with --plan or --apply")
+    if args.undo and (args.plan or args.apply or args.watch):
+        parser.error("--undo can't be combined with --plan, --apply or --watch")
+    if args.journal is None:
+        args.journal = default_journal_path(args)
+    if args.resume and args.dryrun:
+        # Finishing interrupted moves means removing partial copies and sources; there is nothing to preview
+        parser.error("--resume can't be combined with --dryrun")
+    if args.duplicates == "quarantine" and not args.quarantine:
+        parser.error("--duplicates quarantine needs a --quarantine directory")
+    return args
+
+
+def default_journal_path(args):
+    # One journal per --indir/--shard/--apply, so unrelated runs started from the same directory each get their own
+    # and only runs that would work on the same files lock each other out
+    if not config.journal_path:
+        return ""
+    key = json.dumps([os.path.abspath(args.indir), args.shard, os.path.abspath(args.apply) if args.apply else None])
+    stem, extension = os.path.splitext(config.journal_path)
+    return f"{stem}-{hashlib.sha1(key.encode()).hexdigest()[:8]}{extension}"
+
+
+directories_ready = False
+
+
+def ensure_directories(args):
+    # Called once there is something to move, so runs over an empty --indir don't touch the output share
+    global directories_ready
+    if directories_ready:
+        return
+    directories_ready = True
+    for path in [args.sceneroot, args.galleryroot]:
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+                logging.info(f"Created missing directory: {path}")
+            except Exception as e:
+                logging.error(f"Failed to create directory {path}: {e}")
+
+
+log_listener = None
+audit_enabled = False
+
+
+def setup_logging(verbose, audit_path=""):
+    # Workers only put records on a queue; a listener thread formats them and writes them out
+    global log_listener, audit_enabled
+    level = logging.DEBUG if verbose else logging.INFO
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(levelname)s: %(file_tag)s%(message)s'))
+    handlers = [console]
+
+    if config.logfile_path:
+        try:
+            file_handler = BatchedFileHandler(config.logfile_path, mode='a', encoding='utf-8')
+            file_handler.setLevel(logging.INFO)
+            file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(file_tag)s%(message)s'))
+
+            # ⛔️ Skip dryrun entries in the file log
+            file_handler.addFilter(SkipDryRunFilter())
+
+            handlers.append(file_handler)
+        except Exception as e:
+            print(f"⚠️ Failed to set up file logging: {e}")
+
+    for handler in handlers:
+        handler.addFilter(SkipAuditFilter())
+
+    if audit_path:
+        try:
+            audit_handler = BatchedFileHandler(audit_path, mode='a', encoding='utf-8')
+            audit_handler.addFilter(AuditOnlyFilter())
+            audit_handler.setFormatter(AuditFormatter())
+            handlers.append(audit_handler)
+            audit_enabled = True
+        except OSError as e:
+            print(f"⚠️ Failed to open audit log {audit_path}: {e}")
+
+    # The file tag comes from the worker thread's context, so it has to be filled in before the record is queued
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(FileContextFilter())
+    logging.basicConfig(level=level, handlers=[queue_handler])
+
+    log_listener = BatchingQueueListener(log_queue, *handlers)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+def audit(event, **fields):
+    if audit_enabled:
+        logging.getLogger("FileRenamer.audit").info(event, extra={'audit': fields})
+
+
+def validate_config():
+    required = [config.server_ip, config.server_port]
+    if not all(required):
+        logging.error("Missing required config values: server_ip or server_port")
+        sys.exit(1)
+
+    config.server = build_server_url()
+
+
+def build_server_url():
+    protocol = "https" if config.use_https else "http"
+    return f"{protocol}://{config.server_ip}:{config.server_port}"
+
+
+class HttpClient:
+    def __init__(self, pool_size, connect_timeout, read_timeout, verify=True):
+        # One keep-alive pool shared by every GraphQL query and screenshot download.  requests is imported here
+        # rather than at the top: it is the slowest import by far, and runs with nothing to do never need it.
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.session.verify = verify
+        self.timeout = (connect_timeout, read_timeout)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def connection_stats(self):
+        opened = 0
+        sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return opened, max(sent - opened, 0)
+
+    def close(self):
+        self.session.close()
+
+
+http_client = None
+http_client_lock = threading.RLock()
+
+
+def get_http_client():
+    # Created, and authenticated, on first use.  Other threads wait here until authentication is done.
+    # Callers check network_allowed() first; a --cache-only run never gets this far.
+    global http_client
+    if not network_allowed():
+        raise RuntimeError("--cache-only run tried to contact Stash")
+    with http_client_lock:
+        if http_client is None:
+            http_client = HttpClient(
+                config.http_pool_size,
+                config.http_connect_timeout,
+                config.http_read_timeout,
+                verify=not config.ignore_ssl_warnings,
+            )
+            authenticate(http_client)
+    return http_client
+
+
+def set_auth(server):
+    import requests
+    try:
+        r = get_http_client().get(f"{server}/playground")
+        if r.history and r.history[-1].status_code == 302:
+            config.auth = "jwt"
+            return jwt_auth(server)
+        elif r.status_code == 200:
+            config.auth = "none"
+        else:
+            config.auth = "basic"
+        return True
+    except requests.RequestException as e:
+        logging.error(f"Failed to connect to server: {e}")
+        return False
+
+
+def jwt_auth(server):
+    import requests
+    try:
+        response = get_http_client().post(f"{server}/login", data={'username': config.username, 'password': config.password})
+        token = response.cookies.get('session')
+        if not token:
+            logging.error("JWT authentication failed")
+            return False
+        config.headers['Authorization'] = f"Bearer {token}"
+        return True
+    except requests.RequestException as e:
+        logging.error(f"JWT auth error: {e}")
+        return False
+
+
+def auth_cache_file():
+    return os.path.expanduser(config.auth_cache_path) if config.auth_cache_path else ""
+
+
+def load_auth(client):
+    # Auth worked out by an earlier run, so startup doesn't have to probe /playground or log in again
+    path = auth_cache_file()
+    if not path:
+        return False
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if saved.get('server') != config.server or time.time() - saved.get('saved', 0) > config.auth_cache_hours * 3600:
+        return False
+
+    config.auth = saved.get('auth', "none")
+    config.headers.update(saved.get('headers') or {})
+    client.session.cookies.update(saved.get('cookies') or {})
+    logging.debug("Using cached %s authentication for %s", config.auth, config.server)
+    return True
+
+
+def save_auth(client):
+    path = auth_cache_file()
+    if not path:
+        return
+    saved = {
+        'server': config.server,
+        'auth': config.auth,
+        'headers': {key: value for key, value in config.headers.items() if key == 'Authorization'},
+        'cookies': client.session.cookies.get_dict(),
+        'saved': time.time(),
+    }
+    try:
+        # Holds a session token, so only readable by us
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(saved, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.warning(f"Could not save {path}: {e}")
+
+
+def authenticate(client, refresh=False):
+    if config.api_key:
+        config.auth = "apikey"
+        config.headers['ApiKey'] = config.api_key
+        return
+    if not refresh and load_auth(client):
+        return
+    config.headers.pop('Authorization', None)
+    client.session.cookies.clear()
+    if set_auth(config.server):
+        save_auth(client)
+
+
+auth_lock = threading.Lock()
+auth_generation = 0
+
+
+def reauthenticate(generation):
+    # Several threads can get a 401 for the same expired session; only the first one logs in again
+    global auth_generation
+    with auth_lock:
+        if auth_generation == generation:
+            logging.info("Stash rejected our credentials, authenticating again")
+            authenticate(get_http_client(), refresh=True)
+            auth_generation += 1
+
+
+def send(method, url, headers=None, **kwargs):
+    # Requests to Stash with the current auth headers, authenticating again once if they are turned down
+    generation = auth_generation
+    response = get_http_client().request(method, url, headers={**config.headers, **(headers or {})}, **kwargs)
+    if response.status_code == 401:
+        response.close()
+        reauthenticate(generation)
+        response = get_http_client().request(method, url, headers={**config.headers, **(headers or {})}, **kwargs)
+    return response
+
+
+def in_shard(file, shard):
+    # Files are assigned by their normalized basename, so every part of a gallery lands on the same node
+    if shard is None:
+        return True
+    index, count = shard
+    digest = hashlib.sha1(get_basename(file).lower().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index - 1
+
+
+def matches_mask(name, masks, excludes=()):
+    # Like glob, a mask only matches hidden files if it starts with a dot
+    if not any(fnmatch.fnmatch(name, m) and (m.startswith('.') or not name.startswith('.')) for m in masks):
+        return False
+    return not any(fnmatch.fnmatch(name, m) for m in excludes)
+
+
+def scan_files(indir, masks, excludes=(), recursive=False, min_size=0, min_age=0, skip_dirs=()):
+    # Yields matching files as they are found.  Uses the stat data scandir already has instead of a stat per file.
+    skip_dirs = {os.path.normcase(os.path.abspath(d)) for d in skip_dirs}
+    now = time.time()
+    pending = [indir]
+    while pending:
+        directory = pending.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    name = entry.name
+                    try:
+                        if entry.is_dir():
+                            if recursive and not name.startswith('.') and os.path.normcase(os.path.abspath(entry.path)) not in skip_dirs:
+                                subdirs.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                        if not matches_mask(name, masks, excludes):
+                            continue
+                        if min_size or min_age:
+                            stat = entry.stat()
+                            if stat.st_size < min_size or now - stat.st_mtime < min_age:
+                                continue
+                    except OSError as e:
+                        logging.warning(f"Could not read {entry.path}: {e}")
+                        continue
+                    yield entry.path
+        except OSError as e:
+            logging.error(f"Failed to scan directory {directory}: {e}")
+        pending.extend(sorted(subdirs, reverse=True))
+
+
+archive_groups = {}  # first part of a multi-part archive -> all of its parts, see group_archives
+
+
+def group_archives(files):
+    # Gathers the "-N" parts of .zip archives (gallery-1.zip, gallery-2.zip, ...) so a gallery is looked up,
+    # moved and reported once.  Yields the first part in place of the whole group.  scan_files yields a
+    # directory's files together, so the groups are complete once the directory changes.
+    directory = None
+    groups = {}
+    for file in files:
+        if ".zip" not in file:
+            yield file
+            continue
+        if os.path.dirname(file) != directory:
+            yield from flush_archive_groups(groups)
+            directory = os.path.dirname(file)
+        groups.setdefault(get_basename(file), []).append(file)
+    yield from flush_archive_groups(groups)
+
+
+def flush_archive_groups(groups):
+    for parts in groups.values():
+        parts.sort(key=lambda part: (int(part_number(part) or 0), part))
+        if len(parts) > 1:
+            archive_groups[parts[0]] = parts
+        yield parts[0]
+    groups.clear()
+
+
+def archive_parts(filedata, targetname):
+    # (filedata, targetname) for every part of the file's archive group, each keeping its own part number
+    parts = archive_groups.pop(filedata['filename'], None)
+    if not parts:
+        return [(filedata, targetname)]
+
+    items = []
+    for i, part in enumerate(parts):
+        number = part_number(part)
+        partdata = dict(filedata, filename=part, extension=os.path.splitext(part)[-1])
+        if i:
+            partdata['extra'] = False  # One screenshot and NFO per gallery, next to its first part
+        items.append((partdata, f"{targetname}-{number}" if number else targetname))
+    return items
+
+
+def group_result(results):
+    # A multi-part archive is one item: failed if any part failed, renamed if any part was moved
+    for result in ("error", "renamed", "duplicate", "planned"):
+        if result in results:
+            return result
+    return results[0]
+
+
+def prefetch(iterable, maxsize):
+    # Runs the scan on a background thread so processing can start while it is still walking the tree
+    items = queue.Queue(maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        finally:
+            items.put(done)
+
+    threading.Thread(target=produce, name="scanner", daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        yield item
+
+
+class RateController:
+    # AIMD limit on concurrent GraphQL requests: grows by about one per round trip while Stash answers quickly,
+    # halves when it is slow or overloaded (5xx, 429, timeouts), at most once per round trip.
+    def __init__(self, minimum, maximum, target_latency):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.target_latency = target_latency
+        self.limit = float(self.maximum)
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, latency, overloaded):
+        with self.cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if overloaded or latency > self.target_latency:
+                if now - self.last_decrease > latency:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+                    logging.debug(f"Stash is slow or overloaded, limiting to {int(self.limit)} concurrent requests")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+rate_controller = RateController(config.graphql_min_concurrency, config.graphql_max_concurrency, config.graphql_target_latency)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_http_date(value):
+    import email.utils
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    date = parse_http_date(value)
+    return max(date - time.time(), 0.0) if date is not None else None
+
+
+def call_graphql(query):
+    import requests
+    error = None
+    for attempt in range(config.graphql_retries + 1):
+        retry_after = None
+        overloaded = False
+        rate_controller.acquire()
+        started = time.monotonic()  # After acquire: waiting for a slot is our own doing, not Stash being slow
+        try:
+            with metrics.stage("graphql"):
+                response = send("POST", f"{config.server}/graphql", json={'query': query})
+                if response.status_code in RETRY_STATUSES:
+                    overloaded = True
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    error = f"HTTP {response.status_code}"
+                else:
+                    response.raise_for_status()
+                    return response.json()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            overloaded = True
+            error = e
+        except requests.RequestException as e:
+            logging.error(f"GraphQL query failed: {e}")
+            return {}
+        finally:
+            rate_controller.release(time.monotonic() - started, overloaded)
+
+        if attempt < config.graphql_retries:
+            # Full jitter, unless the server said how long to wait
+            delay = retry_after if retry_after is not None else random.uniform(0, config.graphql_backoff_base * 2 ** attempt)
+            delay = min(delay, config.graphql_backoff_max)
+            logging.warning(f"GraphQL request failed ({error}), retrying in {delay:.1f}s (attempt {attempt + 1} of {config.graphql_retries})")
+            time.sleep(delay)
+
+    logging.error(f"GraphQL query failed: {error}")
+    return {}
+
+
+def fetch_metadata(basename):
+    try:
+        field, selection = scene_query()
+        query = f"query {{\n  {lookup_field(field, basename)} {selection}\n}}"
+    except ValueError:
+        query = config.file_query.replace("<FILENAME>", basename)
+    result = call_graphql(query)
+    if not result or not isinstance(result, dict):
+        logging.error(f"No result returned for query: {basename}")
+        return {}
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"GraphQL response for {basename}:\n{json.dumps(result, indent=2)}")
+    return result
+
+
+def find_closing(text, start, opener, closer):
+    depth = 0
+    for pos in range(start, len(text)):
+        if text[pos] == opener:
+            depth += 1
+        elif text[pos] == closer:
+            depth -= 1
+            if depth == 0:
+                return pos
+    raise ValueError(f"Unbalanced '{opener}' in query")
+
+
+def split_scene_query(query):
+    # Splits config.file_query into the 'findScenes(...)' call and its '{ ... }' selection set
+    field_start = query.index("findScenes")
+    args_end = find_closing(query, query.index("(", field_start), "(", ")")
+    selection_start = query.index("{", args_end)
+    selection_end = find_closing(query, selection_start, "{", "}")
+    return query[field_start:args_end + 1], query[selection_start:selection_end + 1]
+
+
+# Scene fields needed always (None) and for each name_format placeholder
+SCENE_FIELDS = {
+    None: ["id", "studio.id", "studio.name", "files.path"],
+    "<TITLE>": ["title", "code"],
+    "<STUDIOID>": ["title", "code"],
+    "<PARENT>": ["studio.parent_studio.id", "studio.parent_studio.name"],
+    "<DATE>": ["date"],
+    "<TAGS>": ["tags.name"],
+    "<PERFORMERS>": ["performers.name"],
+    "<DIMENSIONS>": ["files.width", "files.height"],
+}
+
+# ...and for the NFO and screenshot written with --extra
+EXTRA_FIELDS = ["title", "details", "date", "paths.screenshot", "studio.parent_studio.id", "studio.parent_studio.name",
+                "tags.id", "tags.name", "performers.name", "performers.image_path"]
+
+
+def build_selection(fields):
+    # ["studio.id", "studio.name"] -> "{ studio { id name } }"
+    tree = {}
+    for field in fields:
+        node = tree
+        for part in field.split("."):
+            node = node.setdefault(part, {})
+
+    def render(node):
+        return "{ " + " ".join(f"{name} {render(child)}" if child else name for name, child in node.items()) + " }"
+
+    return render(tree)
+
+
+scene_selection = None
+
+
+def shape_scene_query(args):
+    # Only ask Stash for the fields this run uses instead of everything in file_query's selection
+    global scene_selection
+    if not config.shape_queries:
+        return
+    fields = list(SCENE_FIELDS[None])
+    for placeholder, needed in SCENE_FIELDS.items():
+        if placeholder and placeholder in config.name_format:
+            fields += needed
+    if args.extra:
+        fields += EXTRA_FIELDS
+    scene_selection = build_selection(f"scenes.{field}" for field in dict.fromkeys(fields))
+    logging.debug(f"Scene selection: {scene_selection}")
+
+
+def scene_query():
+    field, selection = split_scene_query(config.file_query)
+    return field, scene_selection or selection
+
+
+OSHASH_CHUNK = 64 * 1024
+
+oshash_field = 'findScenes(scene_filter: { oshash: { value: "<OSHASH>", modifier: EQUALS } })'
+
+
+def read_at(f, offset, length):
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), length, offset)
+    f.seek(offset)
+    return f.read(length)
+
+
+def compute_oshash(path):
+    # Stash's oshash: file size plus the sum of the little-endian 64 bit words in the first and last 64 KiB
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            chunk = min(size, OSHASH_CHUNK)
+            data = read_at(f, 0, chunk) + read_at(f, size - chunk, chunk)
+    except OSError:
+        return None
+
+    words = len(data) // 8
+    total = size + sum(struct.unpack(f"<{words}Q", data[:words * 8]))
+    return f"{total & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def compute_sample(path):
+    # (size, hash of the first and last duplicate_sample_bytes), enough to tell copies of a video apart from other
+    # encodes without reading gigabytes.  None if the file can't be read.
+    chunk = config.duplicate_sample_bytes
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = hashlib.sha1(str(size).encode())
+            digest.update(read_at(f, 0, min(size, chunk)))
+            if size > chunk:
+                tail = min(chunk, size - chunk)
+                digest.update(read_at(f, size - tail, tail))
+    except OSError:
+        return None
+    return size, digest.hexdigest()
+
+
+hash_pool = None
+
+
+def hash_files(files, hasher=compute_oshash):
+    global hash_pool
+    if hash_pool is None:
+        hash_pool = ProcessPoolExecutor(max_workers=config.hash_workers)
+    with metrics.stage("hash"):
+        return list(hash_pool.map(hasher, files, chunksize=8))
+
+
+def lookup_field(field, key):
+    # Lookup keys are either a basename for the file_query path search, or "oshash:<hash>"
+    if key.startswith("oshash:"):
+        return oshash_field.replace("<OSHASH>", key[len("oshash:"):])
+    return field.replace("<FILENAME>", key)
+
+
+def fetch_metadata_batch(basenames):
+    # One request with an aliased findScenes per basename.  Returns None if Stash rejected the batched query, so
+    # the files are looked up one by one; if the request itself failed, every file gets the empty failed result.
+    try:
+        field, selection = scene_query()
+    except ValueError as e:
+        logging.warning(f"Cannot batch file_query ({e}), falling back to single queries")
+        return None
+
+    parts = [f"s{i}: {lookup_field(field, basename)} {selection}" for i, basename in enumerate(basenames)]
+    result = call_graphql("query {\n" + "\n".join(parts) + "\n}")
+
+    if isinstance(result, dict) and result.get('errors'):
+        logging.warning(f"Batched query for {len(basenames)} files failed, falling back to single queries")
+        return None
+    data = result.get('data') if isinstance(result, dict) else None
+    if not isinstance(data, dict):
+        # Stash unreachable or failing even after call_graphql's retries: single queries would only repeat that per file
+        logging.error(f"Batched query for {len(basenames)} files failed")
+        return {basename: {} for basename in basenames}
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    results = {}
+    for i, basename in enumerate(basenames):
+        results[basename] = {'data': {'findScenes': data.get(f"s{i}")}}
+        if debug:
+            logging.debug(f"GraphQL response for {basename}:\n{json.dumps(results[basename], indent=2)}")
+    return results
+
+
+scene_index_query = """
+    query {
+      findScenes(<FILTER>filter: { page: <PAGE>, per_page: <PER_PAGE>, sort: "updated_at", direction: ASC }) {
+        count
+        scenes {
+          id
+          updated_at
+          files {
+            basename
+          }
+        }
+      }
+    }
+"""
+
+
+class SceneIndex:
+    def __init__(self):
+        self.scenes = {}    # scene id -> [index keys of its files]
+        self.by_name = {}   # index key -> [scene ids]
+        self.updated_at = ""
+
+    @staticmethod
+    def key(filename):
+        # Same normalization as the basename we search with, case-folded like Stash's path search
+        return get_basename(filename).lower()
+
+    def add(self, sceneid, keys):
+        for key in self.scenes.pop(sceneid, []):
+            ids = self.by_name.get(key, [])
+            if sceneid in ids:
+                ids.remove(sceneid)
+        self.scenes[sceneid] = keys
+        for key in keys:
+            self.by_name.setdefault(key, []).append(sceneid)
+
+    def lookup(self, basename):
+        return self.by_name.get(basename.lower(), [])
+
+    def load(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read scene index {path}: {e}. Rebuilding.")
+            return False
+
+        for sceneid, keys in saved.get('scenes', {}).items():
+            self.add(sceneid, keys)
+        self.updated_at = saved.get('updated_at', "")
+        return True
+
+    def save(self, path):
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({'updated_at': self.updated_at, 'scenes': self.scenes}, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning(f"Could not save scene index {path}: {e}")
+
+    def update(self, page_size):
+        # Pages through every scene, or only the ones changed since the last update when the index was loaded from disk
+        scene_filter = ""
+        if self.updated_at:
+            scene_filter = f'scene_filter: {{ updated_at: {{ value: "{self.updated_at}", modifier: GREATER_THAN }} }}, '
+
+        page = 1
+        fetched = 0
+        while True:
+            query = scene_index_query.replace("<FILTER>", scene_filter).replace("<PAGE>", str(page)).replace("<PER_PAGE>", str(page_size))
+            result = call_graphql(query)
+            data = result.get('data') if isinstance(result, dict) else None
+            found = data.get('findScenes') if isinstance(data, dict) else None
+            if not isinstance(found, dict):
+                logging.error("Failed to page through scenes while building the scene index")
+                return False
+
+            scenes = found.get('scenes') or []
+            for scene in scenes:
+                keys = [self.key(f['basename']) for f in scene.get('files') or [] if f.get('basename')]
+                self.add(str(scene['id']), keys)
+                self.updated_at = max(self.updated_at, scene.get('updated_at') or "")
+            fetched += len(scenes)
+
+            if not scenes or page * page_size >= found.get('count', 0):
+                break
+            page += 1
+
+        logging.info(f"Scene index updated with {fetched} scenes ({len(self.scenes)} total)")
+        return True
+
+
+scene_index = None
+
+
+def open_scene_index(args):
+    global scene_index
+    if not args.index:
+        return None
+
+    scene_index = SceneIndex()
+    if args.index_file and scene_index.load(args.index_file):
+        logging.info(f"Loaded scene index with {len(scene_index.scenes)} scenes from {args.index_file}")
+
+    if network_allowed():
+        if not scene_index.update(config.index_page_size):
+            if not scene_index.scenes:
+                logging.error("Scene index is empty, cannot continue in --index mode")
+                sys.exit(1)
+        elif args.index_file:
+            scene_index.save(args.index_file)
+    return scene_index
+
+
+def fetch_scenes_by_id(sceneids):
+    # Full metadata for the index matches, in one request.  Returns None if the request failed; raises ValueError
+    # if file_query can't be turned into a by-id query.
+    field, selection = scene_query()
+    ids = ", ".join(sceneids)
+    result = call_graphql(f"query {{\n  findScenes(scene_ids: [{ids}], filter: {{ per_page: -1 }}) {selection}\n}}")
+
+    data = result.get('data') if isinstance(result, dict) else None
+    found = data.get('findScenes') if isinstance(data, dict) else None
+    if not isinstance(found, dict):
+        logging.error(f"Failed to fetch {len(sceneids)} scenes by id")
+        return None
+    return {str(scene.get('id')): scene for scene in found.get('scenes') or []}
+
+
+def fetch_metadata_indexed(basenames):
+    matches = {basename: scene_index.lookup(basename) for basename in basenames}
+    sceneids = list(dict.fromkeys(i for ids in matches.values() for i in ids))
+
+    scenes = {}
+    if sceneids:
+        try:
+            scenes = fetch_scenes_by_id(sceneids)
+        except ValueError as e:
+            logging.error(f"Cannot build a by-id query from file_query: {e}")
+            return {}  # Single queries still work
+        if scenes is None:
+            return {basename: {} for basename in basenames}
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    results = {}
+    for basename, ids in matches.items():
+        results[basename] = {'data': {'findScenes': {'scenes': [scenes[i] for i in ids if i in scenes]}}}
+        if debug:
+            logging.debug(f"GraphQL response for {basename}:\n{json.dumps(results[basename], indent=2)}")
+    return results
+
+
+def batched(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def should_process(scene_data):
+    return scene_data and scene_data.get("studio")
+
+
+def has_single_file(scene_data):
+    return isinstance(scene_data.get('files'), list) and len(scene_data['files']) == 1
+
+
+def scene_studio_id(scene_data):
+    studio = scene_data.get('studio')
+    return studio.get('id') if isinstance(studio, dict) else None
+
+
+def renamable(scene_data):
+    # Everything resolve_file checks before working out a target
+    return bool(should_process(scene_data) and has_single_file(scene_data) and scene_studio_id(scene_data))
+
+
+class MetadataCache:
+    def __init__(self, path, ttl_hours, refresh=False, offline=False, fields=""):
+        self.ttl = ttl_hours * 3600
+        self.fields = fields  # Lookups made with a shaped selection are cached apart from ones with other fields
+        self.refresh = refresh
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.pending = 0
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scenes (basename TEXT PRIMARY KEY, payload TEXT, fetched REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS studios (id TEXT PRIMARY KEY, chain TEXT, fetched REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS screenshots (path TEXT PRIMARY KEY, validators TEXT, fetched REAL)")
+        self.conn.commit()
+
+    def get(self, table, key_column, key):
+        if self.refresh:
+            return None
+        with self.lock:
+            row = self.conn.execute(f"SELECT * FROM {table} WHERE {key_column} = ?", (key,)).fetchone()
+        if not row or (self.ttl > 0 and time.time() - row[2] > self.ttl):
+            return None
+        return json.loads(row[1])
+
+    def put(self, table, key, value):
+        with self.lock:
+            self.conn.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+            self.pending += 1
+            if self.pending >= 100:
+                self.conn.commit()
+                self.pending = 0
+
+    def scene_key(self, basename):
+        return f"{self.fields}:{basename}" if self.fields else basename
+
+    def get_scene(self, basename):
+        return self.get("scenes", "basename", self.scene_key(basename))
+
+    def put_scene(self, basename, metadata):
+        # Only cache answers the file can be renamed with.  Files Stash hasn't scanned yet, or whose scene is
+        # skipped (no studio, several files), stay in --indir and are asked about again once that is fixed.
+        scenes = ((metadata.get('data') or {}).get('findScenes') or {}).get('scenes')
+        if scenes and isinstance(scenes[0], dict) and renamable(scenes[0]):
+            self.put("scenes", self.scene_key(basename), metadata)
+
+    def get_studio_chain(self, studioid):
+        return self.get("studios", "id", studioid)
+
+    def put_studio_chain(self, studioid, chain):
+        self.put("studios", studioid, chain)
+
+    def get_screenshot(self, path):
+        return self.get("screenshots", "path", path)
+
+    def put_screenshot(self, path, validators):
+        self.put("screenshots", path, validators)
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+metadata_cache = None
+
+
+def open_metadata_cache(args):
+    import sqlite3
+    global metadata_cache
+    if not args.cache:
+        if args.cache_only:
+            logging.error("--cache-only needs a cache file")
+            sys.exit(1)
+        return None
+    try:
+        fields = hashlib.sha1(scene_selection.encode()).hexdigest()[:8] if scene_selection else ""
+        metadata_cache = MetadataCache(args.cache, config.cache_ttl_hours, refresh=args.refresh, offline=args.cache_only, fields=fields)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to open cache {args.cache}: {e}")
+        if args.cache_only:
+            sys.exit(1)
+    return metadata_cache
+
+
+def network_allowed():
+    return metadata_cache is None or not metadata_cache.offline
+
+
+studio_query = """
+    query {
+      findStudio(id: "<STUDIONUM>") {
+        id
+        name
+        parent_studio {
+          id
+        }
+      }
+    }
+"""
+
+studios_query = """
+    query {
+      findStudios(filter: { page: <PAGE>, per_page: <PER_PAGE> }) {
+        count
+        studios {
+          id
+          name
+          parent_studio {
+            id
+          }
+        }
+      }
+    }
+"""
+
+
+class StudioCache:
+    def __init__(self):
+        self.studios = {}  # studio id -> (name, parent id)
+        self.chains = {}   # studio id -> [name, parent name, grandparent name, ...]
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def load(self, page_size):
+        self.loaded = True
+        page = 1
+        while True:
+            query = studios_query.replace("<PAGE>", str(page)).replace("<PER_PAGE>", str(page_size))
+            result = call_graphql(query)
+            data = result.get('data') if isinstance(result, dict) else None
+            found = data.get('findStudios') if isinstance(data, dict) else None
+            if not isinstance(found, dict):
+                logging.warning("Could not load studio list from Stash, falling back to per-studio lookups")
+                return False
+
+            studios = found.get('studios') or []
+            for studio in studios:
+                self.add(studio)
+
+            if not studios or page * page_size >= found.get('count', 0):
+                break
+            page += 1
+
+        logging.info(f"Loaded {len(self.studios)} studios from Stash")
+        return True
+
+    def add(self, studio):
+        studioid = str(studio.get('id'))
+        parent = studio.get('parent_studio')
+        if parent is not None and not isinstance(parent, dict):
+            logging.warning(f"Unexpected parent_studio format for studio ID {studioid}: {type(parent)}")
+            parent = None
+        parent_id = parent.get('id') if parent else None
+        self.studios[studioid] = (studio.get('name', f"UnknownStudio_{studioid}"), str(parent_id) if parent_id else None)
+
+    def fetch(self, studioid):
+        # Only used for studios that were not part of the bulk load (e.g. created mid-run)
+        if not network_allowed():
+            logging.warning(f"Studio ID {studioid} is not cached and --cache-only is set.")
+            return False
+
+        result = call_graphql(studio_query.replace("<STUDIONUM>", studioid))
+
+        if not isinstance(result, dict):
+            logging.error(f"Invalid response type for studio ID {studioid}: {type(result)}")
+            return False
+
+        data = result.get('data')
+        if not isinstance(data, dict):
+            logging.error(f"No 'data' field in response for studio ID {studioid}")
+            return False
+
+        studio = data.get('findStudio')
+        if not isinstance(studio, dict):
+            logging.warning(f"Studio ID {studioid} not found or returned null.")
+            return False
+
+        self.add(studio)
+        return True
+
+    def get_chain(self, studioid):
+        studioid = str(studioid)
+        if studioid not in self.chains and metadata_cache is not None:
+            cached = metadata_cache.get_studio_chain(studioid)
+            if cached:
+                self.chains[studioid] = cached
+
+        # The bulk load is deferred until a studio is actually missing, so fully cached reruns never make it
+        if studioid not in self.chains and config.preload_studios and network_allowed():
+            with self.lock:
+                if not self.loaded:
+                    self.load(config.studio_page_size)
+
+        # Walk up until we hit a studio whose chain is already memoized, then fill in the chains on the way back down
+        walked = []
+        chain = []
+        current = studioid
+        complete = True
+        while current:
+            if current in self.chains:
+                chain = self.chains[current]
+                break
+            if current in walked:
+                logging.warning(f"Studio ID {current} appears twice in its own parent path. Ending path trace.")
+                break
+            if current not in self.studios and not self.fetch(current):
+                complete = False
+                break
+            walked.append(current)
+            current = self.studios[current][1]
+            if not current:
+                logging.debug("Studio ID %s has no parent. Ending path trace.", walked[-1])
+
+        for walked_id in reversed(walked):
+            chain = [self.studios[walked_id][0]] + chain
+            if complete:
+                self.chains[walked_id] = chain
+                if metadata_cache is not None:
+                    metadata_cache.put_studio_chain(walked_id, chain)
+
+        return chain
+
+
+studio_cache = StudioCache()
+
+
+def get_parental_path(studioid):
+    with metrics.stage("studio_path"):
+        studiolist = dict(enumerate(studio_cache.get_chain(studioid)))
+
+    if not studiolist:
+        studiolist[0] = "Uncategorized"
+
+    return studiolist
+
+
+def truncate_string(s, max_length=50):
+    if len(s) <= max_length:
+        return s
+    for sep in ['-', '_']:
+        pos = s[:max_length].rfind(sep)
+        if pos != -1:
+            return s[:pos]
+    return s[:max_length]
+
+
+def build_output_path(filedata, args):
+    path = args.outdir
+    if ".zip" in filedata['extension'].lower():
+        path = args.galleryroot
+    else:
+        path = args.sceneroot
+
+    studiolist = filedata.get('studiolist')
+    if not isinstance(studiolist, dict) or not studiolist:
+        logging.warning(f"No valid studio path found for {filedata['filename']}. Using fallback.")
+        studiolist = {0: "Uncategorized"}
+
+    for i in reversed(sorted(studiolist.keys())):
+        studiopath = re.sub(r'[^-a-zA-Z0-9_.() ]+', '', studiolist[i]).strip()
+        path = os.path.join(path, studiopath.title())
+
+    return path
+
+
+class TargetIndex:
+    # Target directories this run has created or looked at, and the names in each, read with one scandir
+    # the first time they're needed.  Saves a makedirs and an exists() round trip per file on network shares.
+    # Callers hold target_lock(directory) while checking or changing a directory's names.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {}  # directory -> set of name keys, or None until it has been scanned
+
+    @staticmethod
+    def dir_key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    @staticmethod
+    def name_key(name):
+        return name.casefold() if config.case_insensitive_targets else os.path.normcase(name)
+
+    def key(self, path):
+        return os.path.join(self.dir_key(os.path.dirname(path)), self.name_key(os.path.basename(path)))
+
+    def makedirs(self, path):
+        key = self.dir_key(path)
+        if key in self.dirs:
+            return
+        try:
+            os.makedirs(path)
+            names = set()  # Just created, nothing to scan
+        except FileExistsError:
+            if not os.path.isdir(path):
+                raise
+            names = None
+        with self.lock:
+            self.dirs.setdefault(key, names)
+
+    def names(self, directory, fresh=False):
+        key = self.dir_key(directory)
+        names = self.dirs.get(key)
+        if names is None or fresh:
+            try:
+                with os.scandir(directory) as entries:
+                    names = {self.name_key(entry.name) for entry in entries}
+            except FileNotFoundError:
+                names = set()
+            with self.lock:
+                self.dirs[key] = names
+        return names
+
+    def exists(self, path):
+        if shared_targets and not config.case_insensitive_targets:
+            # Other machines add names behind our back, so only a fresh look is good enough
+            return os.path.exists(path)
+        return self.name_key(os.path.basename(path)) in self.names(os.path.dirname(path), fresh=shared_targets)
+
+    def add(self, path):
+        names = self.dirs.get(self.dir_key(os.path.dirname(path)))
+        if names is not None:
+            names.add(self.name_key(os.path.basename(path)))
+
+    def discard(self, path):
+        names = self.dirs.get(self.dir_key(os.path.dirname(path)))
+        if names is not None:
+            names.discard(self.name_key(os.path.basename(path)))
+
+    def clear(self):
+        with self.lock:
+            self.dirs.clear()
+
+
+target_index = TargetIndex()
+
+
+LIBRARY_SKIP = (".nfo", ".jpg", ".part", ".tmp")  # Our own sidecars and unfinished copies
+
+
+def library_file(name):
+    # Hidden files (directory lock files among them) and our own sidecars aren't library content
+    return not name.startswith(".") and not name.lower().endswith(LIBRARY_SKIP)
+
+
+class LibraryIndex:
+    # Size and sampled hash of every file under the library roots, so an incoming file is matched against all of
+    # them with one dict lookup.  Kept on disk between runs: the whole library is only walked again every
+    # library_rescan_hours, in between just the directories being moved into are re-read, once per run.
+    def __init__(self, path=""):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}      # path key -> [path, size, mtime_ns, hash]
+        self.by_sample = {}  # (size, hash) -> path key
+        self.refreshed = set()  # directory keys read since the run (or --watch batch) started
+        self.scanned = 0     # when the whole library was last walked
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read library index {self.path}: {e}. Rebuilding.")
+            return False
+        if saved.get('sample_bytes') != config.duplicate_sample_bytes:
+            return False  # Hashes of a different sample size can't be compared
+        for path, size, mtime, digest in saved.get('files', []):
+            key = TargetIndex.dir_key(path)
+            self.files[key] = [path, size, mtime, digest]
+            self.by_sample.setdefault((size, digest), key)
+        self.scanned = saved.get('scanned', 0)
+        return True
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        try:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({'sample_bytes': config.duplicate_sample_bytes, 'scanned': self.scanned,
+                           'files': list(self.files.values())}, f)
+            os.replace(self.path + ".tmp", self.path)
+            self.changed = False
+        except OSError as e:
+            logging.warning(f"Could not save library index {self.path}: {e}")
+
+    def scan(self, roots, skip_dirs=()):
+        # Stats everything under the roots; only new and changed files are read, in the hash process pool
+        skip = {TargetIndex.dir_key(d) for d in skip_dirs if d}
+        found = {}
+        pending = [root for root in roots if root]
+        while pending:
+            directory = pending.pop()
+            if TargetIndex.dir_key(directory) in skip:
+                continue
+            skip.add(TargetIndex.dir_key(directory))
+            self.refreshed.add(TargetIndex.dir_key(directory))
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file() and library_file(entry.name):
+                            try:
+                                stat = entry.stat()
+                            except OSError:
+                                continue  # Removed since the directory was listed
+                            if stat.st_size:  # Empty placeholders reserving a name
+                                found[TargetIndex.dir_key(entry.path)] = (entry.path, stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logging.warning(f"Failed to scan directory {directory}: {e}")
+
+        files = {}
+        stale = []
+        for key, (path, size, mtime) in found.items():
+            entry = self.files.get(key)
+            if entry and entry[1] == size and entry[2] == mtime:
+                files[key] = entry
+            else:
+                stale.append((key, path, mtime))
+        if stale:
+            logging.info(f"Hashing {len(stale)} new or changed library files")
+            for (key, path, mtime), sample in zip(stale, hash_files([path for _, path, _ in stale], compute_sample)):
+                if sample:
+                    files[key] = [path, sample[0], mtime, sample[1]]
+
+        self.changed = True
+        self.scanned = time.time()
+        self.files = files
+        self.by_sample = {}
+        for key, (path, size, mtime, digest) in files.items():
+            self.by_sample.setdefault((size, digest), key)
+
+    def refresh(self, directory):
+        # Re-reads a directory about to be moved into, so files added or removed there since the last scan count
+        key = TargetIndex.dir_key(directory)
+        with self.lock:
+            if key in self.refreshed:
+                return
+            self.refreshed.add(key)
+        present = set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and library_file(entry.name):
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        if stat.st_size:
+                            present.add(TargetIndex.dir_key(entry.path))
+                            self.sample_of(entry.path, stat)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Failed to scan directory {directory}: {e}")
+            return
+        with self.lock:
+            gone = [entry[0] for path_key, entry in self.files.items()
+                    if os.path.dirname(path_key) == key and path_key not in present]
+        for path in gone:
+            self.discard(path)
+
+    def find(self, sample, source):
+        # A library file with the same size and sampled hash as source, checked against the disk first
+        with self.lock:
+            key = self.by_sample.get(sample)
+            entry = self.files.get(key)
+        if entry is None or key == TargetIndex.dir_key(source):
+            return None
+        if self.sample_of(entry[0]) != sample:
+            return None  # Gone or changed since it was indexed
+        return entry[0]
+
+    def sample_of(self, path, stat=None):
+        # The file's sample, from the index while its size and mtime are unchanged
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            self.discard(path)
+            return None
+        entry = self.files.get(TargetIndex.dir_key(path))
+        if entry and entry[1] == stat.st_size and entry[2] == stat.st_mtime_ns:
+            return entry[1], entry[3]
+        sample = compute_sample(path)
+        if sample:
+            self.add(path, sample, stat.st_mtime_ns)
+        return sample
+
+    def add(self, path, sample, mtime=None):
+        if mtime is None:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                return
+        key = TargetIndex.dir_key(path)
+        with self.lock:
+            old = self.files.get(key)
+            if old and self.by_sample.get((old[1], old[3])) == key:
+                del self.by_sample[(old[1], old[3])]
+            self.files[key] = [path, sample[0], mtime, sample[1]]
+            self.by_sample.setdefault(sample, key)
+            self.changed = True
+
+    def discard(self, path):
+        key = TargetIndex.dir_key(path)
+        with self.lock:
+            entry = self.files.pop(key, None)
+            if entry and self.by_sample.get((entry[1], entry[3])) == key:
+                del self.by_sample[(entry[1], entry[3])]
+            self.changed = self.changed or entry is not None
+
+
+library_index = None
+
+
+def open_library_index(args):
+    global library_index
+    if not args.duplicates or args.plan or library_index is not None:
+        return library_index
+
+    library_index = LibraryIndex(args.library_index)
+    if args.library_index and library_index.load():
+        logging.info(f"Loaded library index with {len(library_index.files)} files from {args.library_index}")
+        if time.time() - library_index.scanned < config.library_rescan_hours * 3600:
+            return library_index
+
+    with metrics.stage("library_index"):
+        library_index.scan([args.sceneroot, args.galleryroot], skip_dirs=[args.quarantine, args.indir])
+    library_index.save()
+    logging.info(f"Library index covers {len(library_index.files)} files")
+    return library_index
+
+    library_index = LibraryIndex(args.library_index)
+    if args.library_index and library_index.load():
+        logging.info(f"Loaded library index with {len(library_index.files)} files from {args.library_index}")
+    with metrics.stage("library_index"):
+        library_index.scan([args.sceneroot, args.galleryroot], skip_dirs=[args.quarantine, args.indir])
+    library_index.save()
+    logging.info(f"Library index covers {len(library_index.files)} files")
+    return library_index
+
+
+def create_output_path(path, args):
+    try:
+        with metrics.stage("makedirs"):
+            target_index.makedirs(path)
+    except Exception as e:
+        logging.error(f"Failed to create directory {path}: {e}")
+        path = args.outdir  # fallback to base output
+
+    return path
+
+
+NORMALIZE = re.compile(r'[^a-zA-Z0-9]+')
+TITLE_UNSAFE = re.compile(r'[^-a-zA-Z0-9_.()\[\]\' ,]+')
+FALLBACK_ID = re.compile(r'\[(\d+)\]')
+
+# Filename sanitizing, in this order: drop illegal characters, collapse whitespace, drop anything else unsafe
+FILENAME_ILLEGAL = re.compile(r'[<>:"/\\|?*\x00-\x1F]')
+FILENAME_UNSAFE = re.compile(r'[^\w\-.,()\[\]\' ]+')
+FILENAME_SAFE = re.compile(r'[\w\-.,()\[\]\' ]*')
+
+
+def normalize_string(s):
+    return NORMALIZE.sub('', s).lower()
+
+
+def sanitize_filename(name):
+    # str.split() splits on the same whitespace as \s, and drops it from both ends like strip()
+    if FILENAME_SAFE.fullmatch(name):
+        return " ".join(name.split())
+    return FILENAME_UNSAFE.sub('', " ".join(FILENAME_ILLEGAL.sub('', name).split()))
+
+
+def studio_name(data):
+    studio = data.get('studio')
+    return studio.get('name', 'UnknownStudio') if studio else 'UnknownStudio'
+
+
+def parent_name(data):
+    studio = data.get('studio')
+    parent = studio.get('parent_studio') if studio else None
+    return parent.get('name', studio_name(data)) if isinstance(parent, dict) else studio_name(data)
+
+
+def performers_value(data):
+    performers = ", ".join([p['name'] for p in data.get('performers', [])[:3]])
+    return f"({performers})" if performers else ""
+
+
+def dimensions_value(data):
+    file_info = data.get('files', [{}])[0]
+    width = file_info.get('width')
+    height = file_info.get('height')
+    return f"[{width}x{height}]" if width and height else ""
+
+
+# name_format placeholders after <STUDIOID>, in the order they have always been substituted
+PLACEHOLDER_VALUES = {
+    "<STUDIO>": lambda data, title: studio_name(data).title(),
+    "<PARENT>": lambda data, title: parent_name(data).title(),
+    "<TITLE>": lambda data, title: string.capwords(title),
+    "<ID>": lambda data, title: str(data.get('id', '')),
+    "<DATE>": lambda data, title: data.get('date', ''),
+    "<PERFORMERS>": lambda data, title: performers_value(data),
+    "<TAGS>": lambda data, title: ", ".join([t['name'] for t in data.get('tags', [])]),
+    "<DIMENSIONS>": lambda data, title: dimensions_value(data),
+}
+
+
+class NameTemplate:
+    # name_format parsed once into literal text and placeholders.  Two variants: with the <STUDIOID> slot,
+    # and with " [<STUDIOID>]" dropped for scenes whose code is just their title.
+    def __init__(self, name_format):
+        self.name_format = name_format
+        self.with_id = self.parse(name_format, ["<STUDIOID>"] + list(PLACEHOLDER_VALUES))
+        self.without_id = self.parse(name_format.replace(" [<STUDIOID>]", ""), list(PLACEHOLDER_VALUES))
+
+    @staticmethod
+    def parse(text, placeholders):
+        parts = re.split("(" + "|".join(re.escape(p) for p in placeholders) + ")", text)
+        # Substituting one placeholder at a time, a value next to a stray '<' or '>' could spell out another
+        # placeholder that would then be substituted too.  Such templates keep the old one-at-a-time path.
+        if any("<" in literal or ">" in literal for literal in parts[::2]):
+            return text, None, ()
+        used = [p for p in dict.fromkeys(parts[1::2]) if p != "<STUDIOID>"]
+        return text, parts, used
+
+    def render(self, data, title, studioid=None):
+        text, parts, used = self.with_id if studioid is not None else self.without_id
+        values = {"<STUDIOID>": studioid}
+        for placeholder in used:
+            values[placeholder] = PLACEHOLDER_VALUES[placeholder](data, title)
+        if parts is not None:
+            # Literal text has no '<' or '>', so these can only have come from a value
+            name = "".join([values.get(part, part) for part in parts])
+            if "<" not in name and ">" not in name:
+                return name
+
+        # Slow path, same result as substituting every placeholder in turn
+        name = text if studioid is None else text.replace("<STUDIOID>", studioid)
+        for placeholder, value in PLACEHOLDER_VALUES.items():
+            name = name.replace(placeholder, values[placeholder] if placeholder in values else value(data, title))
+        return name
+
+
+name_templates = {}
+
+
+def name_template(name_format):
+    template = name_templates.get(name_format)
+    if template is None:
+        template = name_templates[name_format] = NameTemplate(name_format)
+    return template
+
+
+def format_filename(filedata, args):
+    data = filedata['jsondata']
+
+    # Title and Code
+    title = TITLE_UNSAFE.sub(' ', data.get('title', 'Untitled')).strip().title()
+    title = truncate_string(title, 100)
+    code = truncate_string(data.get('code', ''), 50)
+
+    # Determine name format
+    studioid = code
+    if normalize_string(title) == normalize_string(code):
+        # Check for fallback ID in original filename
+        fallback_id_match = FALLBACK_ID.search(filedata['basename'])
+        fallback_id = fallback_id_match.group(1) if fallback_id_match else ""
+        if args.dryrun:
+            if fallback_id:
+                logging.info("[DRY-RUN] STUDIOID removed from filename due to equality with TITLE in Stash data for: %s.  Using Fallback ID of [%s] Instead.", filedata['filename'], fallback_id, extra={'dryrun': True})
+            else:
+                logging.info("[DRY-RUN] STUDIOID removed from filename due to equality with TITLE in Stash data for: %s", filedata['filename'], extra={'dryrun': True})
+        else:
+            if fallback_id:
+                logging.info("STUDIOID removed from filename due to equality with TITLE in Stash data for: %s.  Using Fallback ID of [%s] Instead.", filedata['filename'], fallback_id)
+            else:
+                logging.info("STUDIOID removed from filename due to equality with TITLE in Stash data for: %s", filedata['filename'])
+        studioid = fallback_id or None
+
+    # Build filename, then sanitize it for the filesystem
+    name = name_template(config.name_format).render(data, title, studioid)
+    return sanitize_filename(name)
+
+
+target_locks = {}
+target_locks_guard = threading.Lock()
+
+
+def target_lock(path):
+    # One lock per target directory, so the exists-then-move check below can't race between io workers
+    key = os.path.normcase(os.path.abspath(path))
+    with target_locks_guard:
+        if key not in target_locks:
+            target_locks[key] = threading.Lock()
+        return target_locks[key]
+
+
+reserved_targets = set()
+shared_targets = False  # other machines may be moving into the same directories (--shard / dir_locks)
+
+
+@contextlib.contextmanager
+def directory_lock(path):
+    # Cross-machine lock on a target directory: whoever creates the lock file first owns it
+    lockfile = os.path.join(path, ".filerenamer.lock")
+    deadline = time.monotonic() + config.dir_lock_timeout
+    while True:
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                stat = os.stat(lockfile)
+                if time.time() - stat.st_mtime > config.dir_lock_stale_seconds:
+                    break_stale_lock(lockfile, stat)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for lock file {lockfile}")
+            time.sleep(0.05 + random.random() * 0.05)
+
+    try:
+        os.write(fd, f"{socket.gethostname()} {os.getpid()} {time.time():.0f}\n".encode())
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(lockfile)
+        except FileNotFoundError:
+            pass
+
+
+def stale_placeholder(path):
+    # An empty target reserving a name in a shared directory whose run crashed before filling it: older than
+    # dir_lock_stale_seconds, with no copy into it (the .part file) still making progress
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size or time.time() - stat.st_mtime <= config.dir_lock_stale_seconds:
+        return False
+    try:
+        return time.time() - os.path.getmtime(path + ".part") > config.dir_lock_stale_seconds
+    except OSError:
+        return True
+
+
+def break_stale_lock(lockfile, stat):
+    # Two machines can both find the same lock stale.  Renaming it away first means only one of them gets it; if the
+    # file taken turns out not to be the stale one (it was broken and re-created in between), it is put back.
+    claimed = f"{lockfile}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        os.rename(lockfile, claimed)
+    except FileNotFoundError:
+        return
+    taken = os.stat(claimed)
+    if (taken.st_dev, taken.st_ino, taken.st_mtime_ns) == (stat.st_dev, stat.st_ino, stat.st_mtime_ns):
+        logging.warning(f"Removing stale lock file {lockfile}")
+    else:
+        try:
+            rename_new(claimed, lockfile)
+            return
+        except FileExistsError:
+            logging.warning(f"Lost track of lock file {lockfile} while breaking a stale lock")
+    os.remove(claimed)
+
+
+copy_slots = {}
+copy_slots_guard = threading.Lock()
+
+
+def device_slot(device):
+    # Limits how many cross-device copies write to the same target device at once
+    with copy_slots_guard:
+        if device not in copy_slots:
+            copy_slots[device] = threading.BoundedSemaphore(max(config.copies_per_device, 1))
+        return copy_slots[device]
+
+
+def copy_data(fsrc, fdst, size, label):
+    # Kernel-side copy where the platform has one, plain buffered copy otherwise
+    chunk = config.copy_buffer_size
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    next_report = config.copy_progress_bytes
+    methods = [m for m in ("copy_file_range", "sendfile") if hasattr(os, m)]
+
+    while copied < size:
+        count = min(chunk, size - copied)
+        sent = 0
+        while methods:
+            try:
+                if methods[0] == "copy_file_range":
+                    sent = os.copy_file_range(infd, outfd, count)
+                else:
+                    sent = os.sendfile(outfd, infd, copied, count)
+                break
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                logging.debug("%s not usable for %s (%s), trying the next copy method", methods[0], label, e)
+                methods.pop(0)
+                fsrc.seek(copied)
+                fdst.seek(copied)
+        if not methods:
+            data = fsrc.read(count)
+            fdst.write(data)
+            sent = len(data)
+        if sent == 0:
+            break
+
+        copied += sent
+        if next_report and copied >= next_report:
+            logging.debug("Copied %d of %d MiB for %s", copied // (1024 * 1024), size // (1024 * 1024), label)
+            next_report += config.copy_progress_bytes
+
+    return copied
+
+
+def rename_new(source, target, placeholder=False):
+    # Last step of every move.  Never overwrites an existing file, raising FileExistsError instead: os.rename
+    # refuses to on Windows, elsewhere a hard link fails if the name is taken.  The one file we may replace is
+    # our own empty --shard placeholder reserving the name.
+    if placeholder and os.path.isfile(target) and os.path.getsize(target) == 0:
+        os.replace(source, target)
+    elif os.name == "nt":
+        os.rename(source, target)
+    else:
+        try:
+            os.link(source, target)
+        except OSError as e:
+            # Filesystems without hard links (some SMB and FAT mounts): check, then rename
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK):
+                raise
+            if os.path.lexists(target):
+                raise FileExistsError(errno.EEXIST, "File exists", target)
+            os.rename(source, target)
+            return
+        os.unlink(source)
+
+
+def copy_across_devices(source, target, placeholder=False):
+    partial = target + ".part"
+    size = os.path.getsize(source)
+    try:
+        with open(source, "rb") as fsrc, open(partial, "wb") as fdst:
+            copy_data(fsrc, fdst, size, source)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        shutil.copystat(source, partial)
+
+        copied = os.path.getsize(partial)
+        if copied != size:
+            raise OSError(f"copied {copied} of {size} bytes")
+        rename_new(partial, target, placeholder)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    os.remove(source)
+
+
+def transfer_file(source, target, placeholder=False):
+    size = os.path.getsize(source)
+    with metrics.stage("move"):
+        move_across(source, target, placeholder)
+    metrics.add_bytes("moved", size)
+    return size
+
+
+def move_across(source, target, placeholder=False):
+    target_device = os.stat(os.path.dirname(target) or ".").st_dev
+    if os.stat(source).st_dev == target_device:
+        try:
+            rename_new(source, target, placeholder)
+            return
+        except OSError as e:
+            # e.g. bind mounts of the same device; fall back to copying
+            if e.errno != errno.EXDEV:
+                raise
+
+    with device_slot(target_device):
+        copy_across_devices(source, target, placeholder)
+
+
+def move_file(filedata, targetname, dry_run):
+    fullpath = filedata['output_path']
+    extension = filedata['extension']
+    target = os.path.join(fullpath, targetname + extension)
+
+    # With --duplicates, a file already somewhere in the library isn't moved at all (see remove_duplicate)
+    sample = None
+    if library_index is not None:
+        library_index.refresh(fullpath)
+        with metrics.stage("sample"):
+            sample = compute_sample(filedata['filename'])
+        original = library_index.find(sample, filedata['filename']) if sample else None
+        if original:
+            filedata['duplicate_of'] = original
+            return None
+
+    if dry_run:
+        logging.info("[DRY-RUN] Would move: %s → %s", filedata['filename'], target, extra={'dryrun': True})
+    else:
+        # The name is reserved under the directory lock, so long copies into the same directory can run side by side.
+        # When other machines share the directory the reservation is an empty placeholder file they can see.
+        key = target_index.key(target)
+        with target_lock(fullpath), (directory_lock(fullpath) if shared_targets else contextlib.nullcontext()):
+            number = 1
+            while key in reserved_targets or target_index.exists(target):
+                if shared_targets and key not in reserved_targets and stale_placeholder(target):
+                    logging.warning(f"Removing stale placeholder {target} left by an interrupted run")
+                    os.remove(target)
+                    target_index.discard(target)
+                    continue
+                if sample is None:
+                    logging.warning(f"Target file already exists: {target}. Skipping move.")
+                    return None  # or return original path if you prefer
+                if key not in reserved_targets and library_index.sample_of(target) == sample:
+                    filedata['duplicate_of'] = target
+                    return None
+                # A different version (another encode or quality) under the same name: keep both
+                number += 1
+                suffixed = targetname + config.duplicate_suffix.replace("<N>", str(number))
+                logging.info("%s already exists and differs, trying %s", target, suffixed + extension)
+                target = os.path.join(fullpath, suffixed + extension)
+                key = target_index.key(target)
+            if number > 1:
+                targetname = suffixed
+            if shared_targets:
+                os.close(os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            reserved_targets.add(key)
+
+        moved = False
+        try:
+            logging.info("Moving: %s → %s", filedata['filename'], target)
+            journal_event(filedata, "moving")
+            started = time.perf_counter()
+            try:
+                size = transfer_file(filedata['filename'], target, placeholder=shared_targets)
+            except FileExistsError:
+                # Created since the directory was indexed; the final rename refuses to overwrite it
+                logging.warning(f"Target file already exists: {target}. Skipping move.")
+                with target_lock(fullpath):
+                    target_index.add(target)
+                return None
+            journal_event(filedata, "moved")
+            moved = True
+            audit("moved", source=os.path.abspath(filedata['filename']), target=os.path.abspath(target),
+                  scene_id=filedata['jsondata'].get('id'), bytes=size, seconds=round(time.perf_counter() - started, 3))
+        finally:
+            if shared_targets and not moved and os.path.exists(target) and os.path.getsize(target) == 0:
+                os.remove(target)
+            with target_lock(fullpath):
+                reserved_targets.discard(key)
+                if moved:
+                    target_index.add(target)
+            if moved and sample:
+                library_index.add(target, sample)
+            if moved:
+                with target_lock(os.path.dirname(filedata['filename'])):
+                    target_index.discard(filedata['filename'])
+
+    return os.path.join(fullpath, targetname)
+
+
+def remove_duplicate(filedata, args):
+    # The file is already in the library: quarantine or delete it instead of moving it in
+    source, original = filedata['filename'], filedata['duplicate_of']
+    if args.dryrun:
+        logging.info("[DRY-RUN] Would %s %s, a duplicate of %s", args.duplicates, source, original, extra={'dryrun': True})
+        return "duplicate"
+
+    if args.duplicates == "delete":
+        size = os.path.getsize(source)
+        os.remove(source)
+        logging.info("Deleted %s, a duplicate of %s", source, original)
+        audit("deleted", source=os.path.abspath(source), duplicate_of=os.path.abspath(original), bytes=size)
+    else:
+        target_index.makedirs(args.quarantine)
+        stem, extension = os.path.splitext(os.path.basename(source))
+        with target_lock(args.quarantine):
+            target = os.path.join(args.quarantine, stem + extension)
+            number = 1
+            while target_index.exists(target):
+                number += 1
+                target = os.path.join(args.quarantine, stem + config.duplicate_suffix.replace("<N>", str(number)) + extension)
+            logging.info("Quarantining %s, a duplicate of %s → %s", source, original, target)
+            size = transfer_file(source, target)
+            target_index.add(target)
+        # Logged as a move so --undo brings it back
+        audit("moved", source=os.path.abspath(source), target=os.path.abspath(target),
+              duplicate_of=os.path.abspath(original), bytes=size)
+
+    with target_lock(os.path.dirname(source)):
+        target_index.discard(source)
+    journal_event(filedata, "duplicate")
+    return "duplicate"
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def same_content(path, size, digest):
+    # True if path already holds exactly these bytes, so rewriting it would only bump its mtime
+    try:
+        return os.path.getsize(path) == size and file_digest(path) == digest
+    except OSError:
+        return False
+
+
+def screenshot_conditions(target):
+    # Validators for the screenshot already on disk, so an unchanged one is answered with 304 Not Modified
+    import email.utils
+    try:
+        stat = os.stat(target)
+    except OSError:
+        return {}
+    headers = {'If-Modified-Since': email.utils.formatdate(stat.st_mtime, usegmt=True)}
+    cached = metadata_cache.get_screenshot(os.path.abspath(target)) if metadata_cache is not None else None
+    if cached and cached.get('etag') and cached.get('size') == stat.st_size:
+        headers['If-None-Match'] = cached['etag']
+    return headers
+
+
+def download_to(response, path):
+    # Streams the body to path, returning its size and sha1
+    digest = hashlib.sha1()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=256 * 1024):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        raise
+    return size, digest.digest()
+
+
+def get_image(filedata):
+    url = filedata['jsondata'].get('paths', {}).get('screenshot')
+    if url and not network_allowed():
+        logging.info("No screenshot in --cache-only mode for %s", filedata['fullpathname'])
+        return
+    import requests
+    if url:
+        target = filedata['fullpathname'] + ".jpg"
+        headers = screenshot_conditions(target) if config.conditional_screenshots else {}
+        try:
+            with metrics.stage("screenshot"):
+                with send("GET", url, headers=headers, stream=True) as response:
+                    if response.status_code == 304:
+                        logging.info("Screenshot unchanged: %s", target)
+                        return
+                    response.raise_for_status()
+                    size, digest = download_to(response, target + ".part")
+
+                if same_content(target, size, digest):
+                    os.remove(target + ".part")
+                    logging.info("Screenshot unchanged: %s", target)
+                else:
+                    created = not os.path.exists(target)
+                    os.replace(target + ".part", target)
+                    audit("wrote", path=os.path.abspath(target), created=created, bytes=size)
+                # The server's own Last-Modified becomes the file's mtime, which is sent back as If-Modified-Since
+                modified = parse_http_date(response.headers.get('Last-Modified'))
+                if modified and os.stat(target).st_mtime < modified:
+                    os.utime(target, (modified, modified))
+            metrics.add_bytes("downloaded", size)
+            if metadata_cache is not None and response.headers.get('ETag'):
+                metadata_cache.put_screenshot(os.path.abspath(target), {'etag': response.headers['ETag'], 'size': size})
+        except requests.RequestException as e:
+            logging.warning(f"Image download failed: {e}")
+    else:
+        logging.info("No screenshot for %s", filedata['filename'])
+
+
+def generate_nfo(scene):
+    tags = ""
+    if config.create_collection_tags:
+        parent = (scene['studio'].get('parent_studio') or {}).get('name', scene['studio']['name'])
+        tags += f"<tag>Site: {scene['studio']['name']}</tag>\n"
+        tags += f"<tag>Studio: {parent}</tag>\n"
+
+    genres = "\n".join([
+        f"<genre>{t['name']}</genre>"
+        for t in scene['tags']
+        if t['id'] not in config.ignore_tags and "ambiguous" not in t['name'].lower()
+    ])
+
+    performers = "\n".join([
+        f"""    <actor>
+        <name>{p['name']}</name>
+        <role></role>
+        <order>{i}</order>
+        <thumb>{p['image_path']}</thumb>
+    </actor>""" for i, p in enumerate(scene['performers'])
+    ])
+
+    thumbs = f"<thumb aspect='poster'>{scene['paths']['screenshot']}</thumb>"
+    fanart = f"<fanart><thumb>{scene['paths']['screenshot']}</thumb></fanart>"
+
+    rating = str(int(scene['rating']) * 2) if scene.get('rating') else ""
+    date = scene.get('date', "")
+    studio = scene['studio']['name']
+    title = scene.get('title', "Untitled")
+    plot = scene.get('details', "")
+    scene_id = scene['id']
+
+    return f"""<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>
+<movie>
+    <title>{title}</title>
+    <userrating>{rating}</userrating>
+    <plot>{plot}</plot>
+    <uniqueid type="stash">{scene_id}</uniqueid>
+    {tags}
+    <premiered>{date}</premiered>
+    <studio>{studio}</studio>
+    {performers}
+    {thumbs}
+    {fanart}
+    {genres}
+</movie>
+"""
+
+
+def encode_text(content, encoding):
+    # The exact bytes open(..., "w", encoding=encoding) would write, line ending translation included
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding=encoding)
+    text.write(content)
+    text.flush()
+    return buffer.getvalue()
+
+
+def write_file(filename, content, use_utf=True):
+    encoding = "utf-8-sig" if use_utf else None
+    try:
+        with metrics.stage("nfo"):
+            data = encode_text(content, encoding)
+            if same_content(filename, len(data), hashlib.sha1(data).digest()):
+                logging.info("Unchanged, not rewritten: %s", filename)
+                return
+            with open(filename + ".part", "wb") as f:
+                f.write(data)
+            created = not os.path.exists(filename)
+            os.replace(filename + ".part", filename)
+            audit("wrote", path=os.path.abspath(filename), created=created, bytes=len(data))
+        logging.info("Wrote file: %s", filename)
+    except Exception as e:
+        logging.error(f"Failed to write file {filename}: {e}")
+
+
+BASENAME_TRAILING = ''.join(c for c in string.punctuation if c != ']')
+PART_SUFFIX = re.compile(r'(.*)-(\d+)$')
+
+
+def get_basename(file):
+    basename = os.path.splitext(os.path.basename(file))[0].strip().rstrip(BASENAME_TRAILING)
+    part_match = PART_SUFFIX.search(basename)
+    if part_match and ".zip" in file:
+        basename = part_match.group(1)
+    return basename
+
+
+def part_number(file):
+    # "12" for gallery-12.zip, None for files that aren't numbered archive parts
+    if ".zip" not in file:
+        return None
+    part_match = PART_SUFFIX.search(os.path.splitext(os.path.basename(file))[0].strip().rstrip(BASENAME_TRAILING))
+    return part_match.group(2) if part_match else None
+
+
+def resolve_file(file, args, metadata=None):
+    # Network half of processing: query Stash and work out where the file should go
+    basename = get_basename(file)
+
+    if metadata is None:
+        logging.debug("Querying for: %s", basename)
+        metadata = fetch_metadata(basename)
+
+    if not isinstance(metadata, dict):
+        logging.error(f"Metadata is not a dictionary for {basename}")
+        return "error", None, None
+
+    data = metadata.get('data')
+    if not isinstance(data, dict):
+        logging.error(f"No 'data' field in GraphQL response for {basename}")
+        return "error", None, None
+
+    find_scenes = data.get('findScenes')
+    if not isinstance(find_scenes, dict):
+        logging.error(f"'findScenes' field missing or invalid for {basename}")
+        return "error", None, None
+
+    scenes = find_scenes.get('scenes')
+    if not isinstance(scenes, list) or not scenes:
+        logging.warning(f"No scenes found for {basename}")
+        return "missing", None, None
+
+    scene = scenes[0]
+
+    if not should_process(scene):
+        logging.warning(f"Scene data missing studio info: {basename}")
+        return "skipped", None, None
+
+    if not has_single_file(scene):
+        logging.warning(f"Multiple or missing files in Stash for {file}. Skipping.")
+        return "skipped", None, None
+
+    studio_id = scene_studio_id(scene)
+    if not studio_id:
+        logging.warning(f"No studio ID found for {basename}. Skipping.")
+        return "skipped", None, None
+
+    try:
+        filedata = {
+            'jsondata': scene,
+            'filename': file,
+            'basename': basename,
+            'extension': os.path.splitext(file)[-1],
+            'studiolist': get_parental_path(studio_id)
+        }
+
+        filedata['output_path'] = build_output_path(filedata, args)
+        with metrics.stage("format"):
+            targetname = format_filename(filedata, args)
+        return None, filedata, targetname
+
+    except Exception as e:
+        logging.error(f"Unhandled error processing {file}: {e}")
+        logging.debug(f"Scene data: {json.dumps(scene, indent=2)}")
+        return "error", None, None
+
+
+def apply_file(filedata, targetname, args):
+    # Filesystem half of processing: create the studio path, move the file and write the sidecars
+    try:
+        filedata['dryrun'] = args.dryrun
+        if journal is not None and not args.dryrun:
+            journal_event(filedata, "queried", record=plan_record(filedata, targetname, args))
+        filedata['output_path'] = create_output_path(filedata['output_path'], args)
+        filedata['fullpathname'] = move_file(filedata, targetname, args.dryrun)
+        if filedata.get('duplicate_of'):
+            return remove_duplicate(filedata, args)
+        if not filedata['fullpathname']:
+
+            if args.dryrun:
+                logging.info(f"[DRY-RUN] File \'{filedata['filename']}\' not moved due to existing target: {targetname}", extra={'dryrun': True})
+            else:
+                logging.warning(f"File \'{filedata['filename']}\' not moved due to existing target: {targetname}")
+            journal_event(filedata, "skipped")
+            return "skipped"
+
+        write_sidecars(filedata, args)
+        return "renamed"
+
+    except Exception as e:
+        logging.error(f"Unhandled error processing {filedata['filename']}: {e}")
+        logging.debug(f"Scene data: {json.dumps(filedata['jsondata'], indent=2)}")
+        journal_event(filedata, "error")
+        return "error"
+
+
+def write_sidecars(filedata, args, done=()):
+    if filedata.get('extra', args.extra):
+        if "image" not in done:
+            get_image(filedata)
+            journal_event(filedata, "image")
+        nfo = filedata['nfo'] if 'nfo' in filedata else generate_nfo(filedata['jsondata'])
+        write_file(filedata['fullpathname'] + ".nfo", nfo, use_utf=True)
+        journal_event(filedata, "nfo")
+    journal_event(filedata, "done")
+
+
+def plan_record(filedata, targetname, args):
+    scene = filedata['jsondata']
+    record = {
+        # Absolute, so --apply and --resume work from any directory
+        'source': os.path.abspath(filedata['filename']),
+        'output_path': os.path.abspath(filedata['output_path']),
+        'target': targetname,
+        'extension': filedata['extension'],
+        'scene_id': scene.get('id'),
+        'screenshot': (scene.get('paths') or {}).get('screenshot'),
+    }
+    if filedata.get('extra', args.extra):
+        if 'nfo' not in filedata:
+            filedata['nfo'] = generate_nfo(scene)
+        record['nfo'] = filedata['nfo']
+    return record
+
+
+def plan_entry(record):
+    filedata = {
+        'jsondata': {'id': record.get('scene_id'), 'paths': {'screenshot': record.get('screenshot')}},
+        'filename': record['source'],
+        'basename': get_basename(record['source']),
+        'extension': record['extension'],
+        'output_path': record['output_path'],
+        'extra': 'nfo' in record,
+    }
+    if 'nfo' in record:
+        filedata['nfo'] = record['nfo']
+    return filedata, record['target']
+
+
+class PlanWriter:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, filedata, targetname, args):
+        try:
+            record = plan_record(filedata, targetname, args)
+        except Exception as e:
+            logging.error(f"Unhandled error planning {filedata['filename']}: {e}")
+            return "error"
+
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        logging.info("[PLAN] %s → %s", filedata['filename'], os.path.join(filedata['output_path'], targetname + filedata['extension']), extra={'dryrun': True})
+        return "planned"
+
+    def close(self):
+        self.file.close()
+
+
+plan_writer = None
+
+
+def read_plan(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield plan_entry(json.loads(line))
+            except (ValueError, KeyError) as e:
+                logging.error(f"Invalid plan entry on line {number} of {path}: {e}")
+                yield None, None
+
+
+def run_io_tasks(items, task, args, summary):
+    # Runs task(filedata, targetname) for every item on the io workers; a None filedata counts as an error
+    io_slots = threading.BoundedSemaphore(max(args.io_workers, 1) * 4)
+
+    def run_task(filedata, targetname):
+        try:
+            with file_context(filedata['filename']):
+                summary.record(task(filedata, targetname), filedata['filename'])
+        except Exception as e:
+            logging.error(f"Unhandled error processing {filedata['filename']}: {e}")
+            summary.record("error", filedata['filename'])
+        finally:
+            io_slots.release()
+
+    with ThreadPoolExecutor(max(args.io_workers, 1), thread_name_prefix="io") as io_pool:
+        for filedata, targetname in items:
+            if filedata is None:
+                summary.record("error")
+                continue
+            io_slots.acquire()
+            io_pool.submit(run_task, filedata, targetname)
+
+
+def apply_plan(path, args, summary, skip=()):
+    # Only filesystem and screenshot work happens here, spread over the io workers.  skip: sources already
+    # finished from the journal by --resume.
+    def apply_task(filedata, targetname):
+        if not os.path.exists(filedata['filename']):
+            logging.warning(f"Planned file {filedata['filename']} no longer exists. Skipping.")
+            return "skipped"
+        return apply_file(filedata, targetname, args)
+
+    items = read_plan(path)
+    if skip:
+        items = (item for item in items if item[0] is None or os.path.abspath(item[0]['filename']) not in skip)
+    run_io_tasks(items, apply_task, args, summary)
+
+
+def undo(path, args, summary):
+    # Walks an audit log backwards: moved files go back where they came from, sidecars this tool created are removed
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logging.warning(f"Ignoring unreadable line {number} of {path}")
+
+    for entry in reversed(entries):
+        if entry.get('event') == "wrote" and entry.get('created'):
+            if not os.path.exists(entry['path']):
+                continue
+            if args.dryrun:
+                logging.info("[DRY-RUN] Would remove: %s", entry['path'], extra={'dryrun': True})
+            else:
+                os.remove(entry['path'])
+                logging.info("Removed: %s", entry['path'])
+        elif entry.get('event') == "moved":
+            source, target = entry['source'], entry['target']
+            with file_context(target):
+                if not os.path.exists(target):
+                    logging.warning("%s is gone, can't move it back to %s", target, source)
+                    summary.record("skipped", target)
+                    continue
+                if os.path.exists(source):
+                    logging.warning("%s already exists, not moving %s back", source, target)
+                    summary.record("skipped", target)
+                    continue
+                if args.dryrun:
+                    logging.info("[DRY-RUN] Would move back: %s → %s", target, source, extra={'dryrun': True})
+                    summary.record("renamed", target)
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(source), exist_ok=True)
+                    logging.info("Moving back: %s → %s", target, source)
+                    transfer_file(target, source)
+                    summary.record("renamed", target)
+                except OSError as e:
+                    logging.error(f"Failed to move {target} back to {source}: {e}")
+                    summary.record("error", target)
+
+
+def lock_open_file(f):
+    # Exclusive lock on an open file, released by the OS when it is closed or the process dies.  False if another
+    # process holds it.
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+class Journal:
+    # Append-only log of each file's progress.  Lines are fsynced in batches; a crash loses at most the
+    # last unsynced batch, which --resume treats as work that still has to be done.  The file stays locked
+    # while the run is going, so a second run using the same journal refuses to start instead of removing it.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        while True:
+            self.file = open(path, "a", encoding="utf-8")
+            if not lock_open_file(self.file):
+                self.file.close()
+                raise BlockingIOError(errno.EAGAIN, "in use by another run", path)
+            try:
+                if os.name == "nt" or os.path.samestat(os.fstat(self.file.fileno()), os.stat(path)):
+                    break
+            except FileNotFoundError:
+                pass
+            # The run that held the lock finished and removed the file while we waited for it
+            self.file.close()
+
+    def clear(self):
+        with self.lock:
+            self.file.truncate(0)
+
+    def compact(self):
+        # Empties the journal once every file in it is finished, so a long --watch session doesn't grow it forever
+        with self.lock:
+            self.sync()
+            if not self.load(self.path):
+                self.file.truncate(0)
+
+    def write(self, source, state, **fields):
+        fields.update({'src': os.path.abspath(source), 'state': state})
+        line = json.dumps(fields, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.unsynced += 1
+            if self.unsynced >= config.journal_sync_every or time.monotonic() - self.last_sync >= config.journal_sync_seconds:
+                self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self, finished):
+        # A run that got to the end has nothing left to resume.  The file is removed while still locked where
+        # the OS allows it; on Windows an open file can't be removed, so there it goes after closing, unless
+        # another run has opened it by then.
+        with self.lock:
+            self.sync()
+            try:
+                if finished and os.name != "nt":
+                    os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.file.close()
+        try:
+            if finished and os.name == "nt":
+                os.remove(self.path)
+        except (FileNotFoundError, PermissionError):
+            pass
+
+    @staticmethod
+    def load(path):
+        # Latest state and plan record per source file, leaving out files that are already finished
+        entries = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from the crash
+                    entry = entries.setdefault(event['src'], {})
+                    entry['state'] = event['state']
+                    if 'record' in event:
+                        entry['record'] = event['record']
+        except FileNotFoundError:
+            return {}
+        return {src: entry for src, entry in entries.items() if entry['state'] not in ("done", "skipped", "duplicate", "error")}
+
+
+journal = None
+
+
+def journal_event(filedata, state, **fields):
+    if journal is not None and not filedata.get('dryrun'):
+        journal.write(filedata['filename'], state, **fields)
+
+
+def resume_file(filedata, targetname, args, state):
+    target = os.path.join(filedata['output_path'], targetname + filedata['extension'])
+    source = filedata['filename']
+
+    if state in ("queried", "moving"):
+        if os.path.exists(target + ".part"):
+            logging.info(f"Removing partial copy: {target}.part")
+            os.remove(target + ".part")
+        if os.path.exists(source) and os.path.exists(target) and os.path.getsize(target) == 0 < os.path.getsize(source):
+            # Placeholder reserving the name in a shared directory
+            os.remove(target)
+
+        if os.path.exists(source) and os.path.exists(target) and state == "moving" and os.path.getsize(source) == os.path.getsize(target):
+            # The copy was renamed into place but the source wasn't removed yet
+            os.remove(source)
+        elif os.path.exists(source):
+            return apply_file(filedata, targetname, args)
+        elif not os.path.exists(target):
+            logging.error(f"{source} is gone and was never moved to {target}")
+            journal_event(filedata, "error")
+            return "error"
+        journal_event(filedata, "moved")
+
+    logging.info(f"Finishing sidecar files for: {target}")
+    filedata['fullpathname'] = os.path.join(filedata['output_path'], targetname)
+    write_sidecars(filedata, args, done={"image"} if state == "image" else set())
+    return "renamed"
+
+
+def resume_journal(entries, args, summary):
+    items = []
+    for src, entry in entries.items():
+        if 'record' not in entry:
+            continue
+        filedata, targetname = plan_entry(entry['record'])
+        filedata['resume_state'] = entry['state']
+        items.append((filedata, targetname))
+
+    logging.info(f"Resuming {len(items)} unfinished files from the journal")
+    run_io_tasks(items, lambda filedata, targetname: resume_file(filedata, targetname, args, filedata['resume_state']), args, summary)
+
+
+def handle_resolved(filedata, targetname, args):
+    items = archive_parts(filedata, targetname)
+    results = []
+    for partdata, partname in items:
+        with file_context(partdata['filename']) if len(items) > 1 else contextlib.nullcontext():
+            if plan_writer is not None:
+                results.append(plan_writer.write(partdata, partname, args))
+            else:
+                results.append(apply_file(partdata, partname, args))
+    return group_result(results)
+
+
+def process_file(file, args, metadata=None):
+    status, filedata, targetname = resolve_file(file, args, metadata)
+    if status:
+        return status
+    return handle_resolved(filedata, targetname, args)
+
+
+def lookup_keys(batch, args):
+    if args.match != "oshash":
+        return [get_basename(file) for file in batch]
+
+    keys = []
+    for file, oshash in zip(batch, hash_files(batch)):
+        if not oshash:
+            logging.warning(f"Could not compute oshash for {file}")
+        keys.append(f"oshash:{oshash}" if oshash else "")
+    return keys
+
+
+def lookup_batch(batch, args):
+    with metrics.stage("lookup"):
+        return lookup_metadata(batch, args)
+
+
+def lookup_metadata(batch, args):
+    basenames = lookup_keys(batch, args)
+    found = {"": {'data': {'findScenes': {'scenes': []}}}}
+    if metadata_cache is not None:
+        for basename in basenames:
+            cached = metadata_cache.get_scene(basename)
+            if cached is not None:
+                logging.debug("Using cached lookup for: %s", basename)
+                found[basename] = cached
+
+    missing = list(dict.fromkeys(b for b in basenames if b not in found))
+    if missing and not network_allowed():
+        for basename in missing:
+            logging.debug("No cached lookup for: %s", basename)
+            found[basename] = {'data': {'findScenes': {'scenes': []}}}
+        missing = []
+
+    if missing:
+        if scene_index is not None and args.match == "filename":
+            results = fetch_metadata_indexed(missing)
+        else:
+            results = fetch_metadata_batch(missing) if len(missing) > 1 else None
+        for basename in missing:
+            metadata = results.get(basename) if results else fetch_metadata(basename)
+            if metadata_cache is not None and isinstance(metadata, dict):
+                metadata_cache.put_scene(basename, metadata)
+            found[basename] = metadata
+
+    return [found.get(basename) for basename in basenames]
+
+
+def process_sequential(files, args, summary):
+    for batch in batched(files, max(args.batch_size, 1)):
+        for file, metadata in zip(batch, lookup_batch(batch, args)):
+            try:
+                summary.record(process_file(file, args, metadata), file)
+            except Exception as e:
+                logging.error(f"Unhandled error processing {file}: {e}")
+                summary.record("error", file)
+
+
+def process_concurrent(files, args, summary):
+    # Lookups run on one pool and hand resolved files to a second pool for the filesystem work.
+    # The semaphores bound how many batches are in flight and how many resolved files can wait for an io worker.
+    lookup_slots = threading.BoundedSemaphore(max(args.workers, 1) * 2)
+    io_slots = threading.BoundedSemaphore(max(args.io_workers, 1) * 4)
+
+    def apply_task(filedata, targetname):
+        try:
+            with file_context(filedata['filename']):
+                summary.record(handle_resolved(filedata, targetname, args), filedata['filename'])
+        except Exception as e:
+            logging.error(f"Unhandled error processing {filedata['filename']}: {e}")
+            summary.record("error", filedata['filename'])
+        finally:
+            io_slots.release()
+
+    def lookup_task(batch, io_pool):
+        try:
+            try:
+                results = lookup_batch(batch, args)
+            except Exception as e:
+                logging.error(f"Lookup failed for {len(batch)} files: {e}")
+                results = [{}] * len(batch)
+
+            for file, metadata in zip(batch, results):
+                with file_context(file):
+                    try:
+                        status, filedata, targetname = resolve_file(file, args, metadata)
+                    except Exception as e:
+                        logging.error(f"Unhandled error processing {file}: {e}")
+                        status = "error"
+                if status:
+                    summary.record(status, file)
+                    continue
+                if plan_writer is not None:
+                    with file_context(file):
+                        try:
+                            summary.record(handle_resolved(filedata, targetname, args), file)
+                        except Exception as e:
+                            logging.error(f"Unhandled error processing {file}: {e}")
+                            summary.record("error", file)
+                    continue
+                io_slots.acquire()
+                io_pool.submit(apply_task, filedata, targetname)
+        finally:
+            lookup_slots.release()
+
+    # Leaving the with blocks waits for every submitted task, lookups first
+    with ThreadPoolExecutor(max(args.io_workers, 1), thread_name_prefix="io") as io_pool:
+        with ThreadPoolExecutor(max(args.workers, 1), thread_name_prefix="lookup") as lookup_pool:
+            for batch in batched(files, max(args.batch_size, 1)):
+                lookup_slots.acquire()
+                lookup_pool.submit(lookup_task, batch, io_pool)
+
+
+def merge_summaries(paths):
+    summary = Summary()
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                summary.merge(json.load(f).get('summary', {}))
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read summary {path}: {e}")
+    logging.info(f"Combined summary of {len(paths)} runs")
+    summary.report()
+
+
+def run(args):
+    global plan_writer
+    if args.merge_summaries:
+        merge_summaries(args.merge_summaries)
+        return
+
+    started = time.perf_counter()
+    validate_config()  # ✅ This must be called before anything uses config.server
+    shape_scene_query(args)
+
+    summary = Summary()
+    if args.undo:
+        try:
+            undo(args.undo, args, summary)
+        except OSError as e:
+            logging.error(f"Failed to read audit log {args.undo}: {e}")
+            sys.exit(1)
+        finish_run(args, summary, started)
+        return
+
+    global shared_targets
+    shared_targets = args.shard is not None or config.dir_locks
+    resumed = start_journal(args, summary)
+
+    if args.apply:
+        ensure_directories(args)
+        open_library_index(args)
+        try:
+            apply_plan(args.apply, args, summary, skip=resumed)
+        except OSError as e:
+            logging.error(f"Failed to read plan {args.apply}: {e}")
+            sys.exit(1)
+        close_caches()
+        finish_run(args, summary, started)
+        return
+
+    if args.watch:
+        open_metadata_cache(args)
+        open_scene_index(args)
+        watch(args, summary)
+        close_caches()
+        finish_run(args, summary, started)
+        return
+
+    scanner = scan_files(args.indir, args.mask, args.exclude, args.recursive, args.min_size, args.min_age,
+                         skip_dirs=[args.sceneroot, args.galleryroot])
+    if resumed:
+        scanner = (file for file in scanner if os.path.abspath(file) not in resumed)
+    scanner = group_archives(scanner)
+    if args.shard:
+        scanner = (file for file in scanner if in_shard(file, args.shard))
+    files = prefetch(scanner, config.scan_queue_size)
+
+    first = next(files, None)
+    if first is None:
+        logging.warning("No files found to process.")
+        if resumed:
+            close_caches()
+            finish_run(args, summary, started)
+        elif journal is not None:
+            journal.close(finished=True)
+        return
+    files = itertools.chain([first], files)
+
+    ensure_directories(args)
+    open_library_index(args)
+    open_metadata_cache(args)
+    open_scene_index(args)
+    if args.plan:
+        try:
+            plan_writer = PlanWriter(args.plan)
+        except OSError as e:
+            logging.error(f"Failed to create plan {args.plan}: {e}")
+            sys.exit(1)
+
+    if args.workers > 1 or args.io_workers > 1:
+        process_concurrent(files, args, summary)
+    else:
+        process_sequential(files, args, summary)
+
+    if plan_writer is not None:
+        plan_writer.close()
+        logging.info(f"Wrote plan: {args.plan}")
+
+    close_caches()
+    finish_run(args, summary, started)
+
+
+def close_caches():
+    if metadata_cache is not None:
+        metadata_cache.close()
+
+    if library_index is not None:
+        library_index.save()
+
+    if hash_pool is not None:
+        hash_pool.shutdown()
+
+
+class PollWatcher:
+    # Fallback for platforms without inotify: rescans --indir every watch_poll_seconds
+    def __init__(self, args):
+        self.args = args
+        self.known = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+        for file in scan_files(self.args.indir, self.args.mask, self.args.exclude, self.args.recursive,
+                               skip_dirs=[self.args.sceneroot, self.args.galleryroot]):
+            try:
+                stat = os.stat(file)
+                files[file] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+        return files
+
+    def wait(self, timeout):
+        time.sleep(config.watch_poll_seconds if timeout is None else min(timeout, config.watch_poll_seconds))
+        current = self.snapshot()
+        changed = [file for file, signature in current.items() if self.known.get(file) != signature]
+        self.known = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, args):
+        self.args = args
+        self.skip_dirs = {os.path.normcase(os.path.abspath(d)) for d in [args.sceneroot, args.galleryroot]}
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # watch descriptor -> directory
+        self.add_tree(args.indir)
+
+    def add_tree(self, path):
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                logging.warning(f"Cannot watch {directory}: {os.strerror(self.ctypes.get_errno())}")
+                continue
+            self.dirs[wd] = directory
+            if not self.args.recursive:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    pending.extend(e.path for e in entries if e.is_dir() and not e.name.startswith('.')
+                                   and os.path.normcase(os.path.abspath(e.path)) not in self.skip_dirs)
+            except OSError as e:
+                logging.warning(f"Failed to scan directory {directory}: {e}")
+
+    def read_events(self):
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        changed = []
+        data = self.read_events()
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0"))
+            offset += self.EVENT.size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                logging.warning("Missed filesystem events, rescanning the whole directory")
+                changed.extend(scan_files(self.args.indir, self.args.mask, self.args.exclude, self.args.recursive,
+                                          skip_dirs=[self.args.sceneroot, self.args.galleryroot]))
+                continue
+            if wd not in self.dirs or not name:
+                continue
+
+            path = os.path.join(self.dirs[wd], name)
+            if mask & self.IN_ISDIR:
+                if self.args.recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO) and not name.startswith('.') \
+                        and os.path.normcase(os.path.abspath(path)) not in self.skip_dirs:
+                    # A directory moved in whole may already hold files
+                    self.add_tree(path)
+                    changed.extend(scan_files(path, self.args.mask, self.args.exclude, True, skip_dirs=self.skip_dirs))
+            elif matches_mask(name, self.args.mask, self.args.exclude):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(args):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(args)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify not available ({e}), polling every {config.watch_poll_seconds}s instead")
+    return PollWatcher(args)
+
+
+def watch(args, summary):
+    # pending: files seen but maybe still being written, path -> ((size, mtime), time it last changed)
+    # retries: files Stash didn't know about yet or that failed, path -> (attempts so far, when to try again)
+    watcher = make_watcher(args)
+    pending = {}
+    retries = {}
+    settle = config.watch_settle_seconds
+    for file in scan_files(args.indir, args.mask, args.exclude, args.recursive, skip_dirs=[args.sceneroot, args.galleryroot]):
+        if in_shard(file, args.shard):
+            pending[file] = (None, time.monotonic())
+
+    logging.info(f"Watching {args.indir} for new files (Ctrl+C to stop)")
+    try:
+        while True:
+            now = time.monotonic()
+            wakeups = [since + settle for _, since in pending.values()] + [due for _, due in retries.values()]
+            timeout = max(0.0, min(wakeups) - now) if wakeups else None
+
+            for file in watcher.wait(timeout):
+                if in_shard(file, args.shard):
+                    pending[file] = (None, time.monotonic())
+
+            now = time.monotonic()
+            ready = []
+            for file, (signature, since) in list(pending.items()):
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    del pending[file]
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                if current != signature:
+                    pending[file] = (current, now)
+                elif now - since >= settle:
+                    del pending[file]
+                    if stat.st_size >= args.min_size:
+                        ready.append(file)
+
+            due = [file for file, (_, when) in retries.items() if when <= now and file not in ready]
+            ready.extend(file for file in due if os.path.exists(file))
+            for file in due:
+                if not os.path.exists(file):
+                    del retries[file]
+            if not ready:
+                continue
+
+            if due and scene_index is not None:
+                scene_index.update(config.index_page_size)
+            target_index.clear()  # Files may have come and gone in the target directories while we waited
+            if library_index is not None:
+                library_index.refreshed.clear()
+            watch_batch(ready, retries, args, summary)
+    except KeyboardInterrupt:
+        logging.info("Stopping watch")
+    finally:
+        watcher.close()
+
+
+def watch_batch(files, retries, args, summary):
+    files = list(group_archives(sorted(files)))
+    ensure_directories(args)
+    open_library_index(args)
+    batch_summary = Summary()
+    batch_summary.results = {}
+    if args.workers > 1 or args.io_workers > 1:
+        process_concurrent(files, args, batch_summary)
+    else:
+        process_sequential(files, args, batch_summary)
+
+    for file, result in batch_summary.results.items():
+        parts = archive_groups.pop(file, [file])
+        if result in ("missing", "error"):
+            # inotify won't report these files again, so errors (Stash down, 5xx) are retried like unscanned files
+            attempt = retries.get(file, (0, 0))[0] + 1
+            if attempt <= config.watch_retry_attempts:
+                delay = min(config.watch_retry_seconds * 2 ** (attempt - 1), config.watch_retry_max_seconds)
+                reason = "is not in Stash yet" if result == "missing" else "failed"
+                logging.info(f"{file} {reason}, retrying in {delay}s (attempt {attempt} of {config.watch_retry_attempts})")
+                for part in parts:
+                    retries[part] = (attempt, time.monotonic() + delay)
+                continue
+            logging.warning(f"Giving up on {file} after {config.watch_retry_attempts} retries")
+        for part in parts:
+            retries.pop(part, None)
+        summary.record(result, file)
+
+    if journal is not None:
+        journal.compact()
+
+
+def start_journal(args, summary):
+    # Opens this run's journal and, with --resume, first finishes the files an interrupted run left in it.
+    # Returns the source paths resumed, which the rest of the run leaves alone.
+    if args.resume and not args.journal:
+        logging.error("--resume needs a journal file")
+        sys.exit(1)
+
+    open_journal(args)
+    if not args.resume:
+        if journal is not None and os.path.getsize(args.journal):
+            logging.warning(f"Journal {args.journal} from an unfinished run exists; starting over (use --resume to finish it first)")
+            journal.clear()
+        return set()
+
+    entries = Journal.load(args.journal)
+    if entries:
+        ensure_directories(args)
+        open_library_index(args)
+        resume_journal(entries, args, summary)
+    return set(entries)
+
+
+def open_journal(args):
+    global journal
+    if args.journal and not args.dryrun and not args.plan:
+        try:
+            journal = Journal(args.journal)
+        except BlockingIOError:
+            logging.error(f"Journal {args.journal} is in use by another run; give this run its own --journal")
+            sys.exit(1)
+        except OSError as e:
+            logging.error(f"Failed to open journal {args.journal}: {e}")
+
+
+def finish_run(args, summary, started):
+    if journal is not None:
+        journal.close(finished=True)
+
+    if http_client is not None:
+        summary.connections_opened, summary.connections_reused = http_client.connection_stats()
+        http_client.close()
+
+    if args.summary_out:
+        try:
+            with open(args.summary_out, "w", encoding="utf-8") as f:
+                json.dump({'shard': "/".join(map(str, args.shard)) if args.shard else None,
+                           'host': socket.gethostname(),
+                           'summary': summary.to_dict()}, f, indent=2)
+        except OSError as e:
+            logging.error(f"Failed to write summary {args.summary_out}: {e}")
+
+    summary.report()
+
+    elapsed = time.perf_counter() - started
+    try:
+        if args.report:
+            metrics.write_json(args.report, summary, elapsed)
+            logging.info(f"Wrote run report: {args.report}")
+        if args.prometheus:
+            metrics.write_prometheus(args.prometheus, summary, elapsed)
+    except OSError as e:
+        logging.error(f"Failed to write run report: {e}")
+
+
+def main():
+    args = parse_args()
+    setup_logging(args.verbose, args.audit_log)
+
+    if not args.profile:
+        run(args)
+        return
+
+    if args.workers > 1 or args.io_workers > 1:
+        logging.info("cProfile only sees the main thread; use --workers 1 --io-workers 1 for a complete profile")
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        logging.info(f"Wrote profile: {args.profile}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+import argparse
+import email.utils
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmark harness for FileRenamer.py.  Starts a local stand-in for the Stash GraphQL API with synthetic
+# data, generates a directory of sparse files matching it and runs the renamer end to end against it.
+#
+#   python FileRenamerBench.py --files 2000 --depth 3 --latency 5 -- --workers 8 --batch-size 50
+#
+# --names N instead checks format_filename against the original implementation on N random scenes and
+# name formats, and times both.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark FileRenamer.py against a local mock Stash server")
+    parser.add_argument("--files", type=int, default=500, help="Number of input files to generate")
+    parser.add_argument("--file-size", type=int, default=64 * 1024 * 1024, help="Apparent size of each (sparse) input file in bytes")
+    parser.add_argument("--studios", type=int, default=200, help="Number of studios in the synthetic studio tree")
+    parser.add_argument("--depth", type=int, default=3, help="Depth of the synthetic studio tree")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds the mock server waits before answering each request")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of GraphQL requests answered with 503 + Retry-After")
+    parser.add_argument("--payload-kb", type=int, default=1, help="Approximate size of each scene's details text in KiB")
+    parser.add_argument("--tags", type=int, default=10, help="Tags per scene")
+    parser.add_argument("--performers", type=int, default=3, help="Performers per scene")
+    parser.add_argument("--modes", default="dryrun,move", help="Comma separated runs to do: dryrun, move")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the synthetic library")
+    parser.add_argument("--workdir", help="Directory for the generated files (a temp dir by default)")
+    parser.add_argument("--json", help="Also write the results as JSON to this file")
+    parser.add_argument("--names", type=int, metavar="N", help="Check and time format_filename on N random scenes instead of a full run")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("renamer_args", nargs=argparse.REMAINDER, help="Arguments after '--' are passed to FileRenamer.py")
+    args = parser.parse_args()
+    if args.renamer_args and args.renamer_args[0] == "--":
+        args.renamer_args = args.renamer_args[1:]
+    return args
+
+
+class MockStash:
+    def __init__(self, args):
+        rng = random.Random(args.seed)
+        self.latency = args.latency / 1000.0
+        self.error_rate = args.error_rate
+        self.errors = random.Random(args.seed)
+        self.file_size = args.file_size
+        self.lock = threading.Lock()
+        self.counts = {'graphql': 0, 'image': 0, 'errors': 0, 'graphql_bytes': 0, 'not_modified': 0}
+        self.image = b"\xff\xd8\xff\xe0" + bytes(rng.getrandbits(8) for _ in range(16 * 1024))
+
+        # Studios are spread over 'depth' levels, each one parented to a random studio on the level above
+        self.studios = {}
+        levels = [[] for _ in range(max(args.depth, 1))]
+        for i in range(1, args.studios + 1):
+            level = (i - 1) % len(levels)
+            parent = rng.choice(levels[level - 1]) if level and levels[level - 1] else None
+            self.studios[str(i)] = {'id': str(i), 'name': f"Bench Studio {i}", 'parent': parent}
+            levels[level].append(str(i))
+        leaves = levels[-1] or list(self.studios)
+
+        details = ("Lorem ipsum dolor sit amet. " * (args.payload_kb * 37))[:args.payload_kb * 1024]
+        self.scenes = {}
+        for i in range(1, args.files + 1):
+            basename = f"bench_scene_{i:06d}"
+            scene = {
+                'id': str(i),
+                'title': f"Bench Scene Title {i}",
+                'code': f"BS{i}",
+                'date': "2021-03-04",
+                'details': details,
+                'url': f"https://example.com/scene/{i}",
+                'rating100': rng.randint(0, 100),
+                'updated_at': f"2021-03-04T00:00:00.{i:06d}Z",
+                'studio': rng.choice(leaves),
+                'tags': [{'id': str(100 + t), 'name': f"Tag {t}"} for t in range(args.tags)],
+                'performers': [{'name': f"Performer {i}-{p}", 'image_path': f"http://example.com/p/{p}.jpg"} for p in range(args.performers)],
+                'files': [{
+                    'path': f"/library/{basename}.mp4",
+                    'basename': f"{basename}.mp4",
+                    'width': 1920,
+                    'height': 1080,
+                }],
+                'oshash': f"{(args.file_size + i) & 0xFFFFFFFFFFFFFFFF:016x}",
+            }
+            self.scenes[scene['id']] = scene
+
+    def studio(self, studioid):
+        studio = self.studios[studioid]
+        parent = self.studio(studio['parent']) if studio['parent'] else None
+        return {'id': studioid, 'name': studio['name'], 'details': "", 'image_path': "", 'parent_studio': parent}
+
+    def scene(self, scene, host):
+        result = {key: value for key, value in scene.items() if key not in ('studio', 'oshash')}
+        result['studio'] = self.studio(scene['studio'])
+        result['paths'] = {'screenshot': f"http://{host}/scene/{scene['id']}/screenshot?t=1", 'stream': ""}
+        result['movies'] = []
+        return result
+
+    @staticmethod
+    def page(items, args):
+        page = int(re.search(r'\bpage:\s*(\d+)', args).group(1)) if re.search(r'\bpage:\s*(\d+)', args) else 1
+        per_page = int(re.search(r'per_page:\s*(-?\d+)', args).group(1)) if re.search(r'per_page:\s*(-?\d+)', args) else 25
+        if per_page < 0:
+            return items
+        return items[(page - 1) * per_page:page * per_page]
+
+    def resolve(self, field, args, host):
+        if field == 'findStudio':
+            studioid = re.search(r'id:\s*"?(\w+)', args).group(1)
+            return self.studio(studioid) if studioid in self.studios else None
+
+        if field == 'findStudios':
+            studios = [self.studio(studioid) for studioid in self.studios]
+            return {'count': len(studios), 'studios': self.page(studios, args)}
+
+        scenes = list(self.scenes.values())
+        match = re.search(r'value:\s*"\\"(.*?)\\""', args)
+        if match:
+            needle = match.group(1).lower()
+            scenes = [s for s in scenes if any(needle in f['path'].lower() for f in s['files'])]
+        match = re.search(r'scene_ids:\s*\[([^\]]*)\]', args)
+        if match:
+            scenes = [self.scenes[i] for i in re.findall(r'\d+', match.group(1)) if i in self.scenes]
+        match = re.search(r'oshash:\s*\{\s*value:\s*"(\w+)"', args)
+        if match:
+            scenes = [s for s in scenes if s['oshash'] == match.group(1)]
+        match = re.search(r'updated_at:\s*\{\s*value:\s*"([^"]+)"', args)
+        if match:
+            scenes = [s for s in scenes if s['updated_at'] > match.group(1)]
+        return {'count': len(scenes), 'scenes': [self.scene(s, host) for s in self.page(scenes, args)]}
+
+    @staticmethod
+    def selection(query, pos):
+        # Parses the '{ ... }' selection set starting at pos into {field: sub-selection or None}
+        fields = {}
+        tokens = re.finditer(r'\w+|[{}]', query[query.index("{", pos) + 1:])
+        stack = [fields]
+        last = None
+        for token in tokens:
+            if token.group() == "{":
+                stack[-1][last] = {}
+                stack.append(stack[-1][last])
+            elif token.group() == "}":
+                stack.pop()
+                if not stack:
+                    break
+            else:
+                last = token.group()
+                stack[-1][last] = None
+        return fields
+
+    @classmethod
+    def project(cls, value, fields):
+        # Like a real GraphQL server, only answers with the fields that were asked for
+        if isinstance(value, list):
+            return [cls.project(item, fields) for item in value]
+        if not isinstance(value, dict) or not fields:
+            return value
+        return {name: cls.project(value.get(name), sub) for name, sub in fields.items()}
+
+    def answer(self, query, host):
+        data = {}
+        for match in re.finditer(r'(?:(\w+)\s*:\s*)?\b(findScenes|findStudios|findStudio)\s*(?=\()', query):
+            depth = 0
+            for end in range(match.end(), len(query)):
+                depth += {'(': 1, ')': -1}.get(query[end], 0)
+                if depth == 0:
+                    break
+            result = self.resolve(match.group(2), query[match.end() + 1:end], host)
+            data[match.group(1) or match.group(2)] = self.project(result, self.selection(query, end))
+        return {'data': data}
+
+    def count(self, kind, amount=1):
+        with self.lock:
+            self.counts[kind] += amount
+
+    def reset(self):
+        with self.lock:
+            counts = dict(self.counts)
+            self.counts = {key: 0 for key in self.counts}
+        return counts
+
+    def serve(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out as separate writes; without this Nagle adds ~40ms to every response
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def reply(self, body, content_type="application/json", status=200, headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(mock.latency)
+                if self.path.startswith("/scene/"):
+                    mock.count('image')
+                    # Screenshots never change here: answer conditional requests with 304 like Stash would
+                    validators = [("ETag", '"bench"'), ("Last-Modified", "Thu, 04 Mar 2021 00:00:00 GMT")]
+                    since = self.headers.get("If-Modified-Since")
+                    if self.headers.get("If-None-Match") == '"bench"' or (since and email.utils.parsedate_to_datetime(since).year >= 2021):
+                        mock.count('not_modified')
+                        return self.reply(b"", "image/jpeg", status=304, headers=validators)
+                    self.reply(mock.image, "image/jpeg", headers=validators)
+                else:
+                    self.reply(b"<html></html>", "text/html")
+
+            def do_POST(self):
+                time.sleep(mock.latency)
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                mock.count('graphql')
+                if mock.error_rate and mock.errors.random() < mock.error_rate:
+                    mock.count('errors')
+                    return self.reply(b'{"error": "busy"}', status=503, headers=[("Retry-After", "0")])
+                answer = json.dumps(mock.answer(body.get('query', ""), self.headers['Host'])).encode()
+                mock.count('graphql_bytes', len(answer))
+                self.reply(answer)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def make_input_dir(indir, count, size):
+    # Sparse files, so a big library costs no disk space.  The scene number in the first 8 bytes
+    # gives every file a distinct oshash (size + number) for --match=oshash runs.
+    if os.path.exists(indir):
+        shutil.rmtree(indir)
+    os.makedirs(indir)
+    for i in range(1, count + 1):
+        with open(os.path.join(indir, f"bench_scene_{i:06d}.mp4"), "wb") as f:
+            f.write(i.to_bytes(8, "little"))
+            f.truncate(max(size, 8))
+
+
+def run_child(settings):
+    # Runs inside the benchmark's child process: point the config at the mock server and run the renamer
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import FileRenamerConfig as config
+    config.use_https = False
+    config.server_ip = "127.0.0.1"
+    config.server_port = str(settings['port'])
+    config.logfile_path = ""
+    config.auth_cache_path = ""
+    config.scene_root = settings['sceneroot']
+    config.gallery_root = settings['galleryroot']
+
+    import FileRenamer
+    sys.argv = ["FileRenamer.py"] + settings['argv']
+    FileRenamer.main()
+
+
+def run_renamer(settings):
+    command = [sys.executable, os.path.abspath(__file__), "--child", json.dumps(settings)]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        stderr = process.stderr.read()
+        process.stderr.close()
+    else:
+        _, stderr = process.communicate()
+        returncode = process.returncode
+        peak_rss = None
+    elapsed = time.perf_counter() - started
+
+    if returncode != 0:
+        print(stderr.decode(errors="replace"), file=sys.stderr)
+    return elapsed, peak_rss, returncode
+
+
+def legacy_format_filename(filedata, args, name_format, truncate_string):
+    # format_filename as it was before name_format was compiled, minus the logging.  Reference for --names.
+    data = filedata['jsondata']
+
+    performers = ", ".join([p['name'] for p in data.get('performers', [])[:3]])
+    performer_str = f"({performers})" if performers else ""
+    tags = ", ".join([t['name'] for t in data.get('tags', [])])
+    file_info = data.get('files', [{}])[0]
+    width = file_info.get('width')
+    height = file_info.get('height')
+    dimensions = f"[{width}x{height}]" if width and height else ""
+
+    title = re.sub(r'[^-a-zA-Z0-9_.()\[\]\' ,]+', ' ', data.get('title', 'Untitled')).strip().title()
+    title = truncate_string(title, 100)
+    code = truncate_string(data.get('code', ''), 50)
+    normalized_title = re.sub(r'[^a-zA-Z0-9]+', '', title).lower()
+    normalized_code = re.sub(r'[^a-zA-Z0-9]+', '', code).lower()
+
+    fallback_id_match = re.search(r'\[(\d+)\]', filedata['basename'])
+    fallback_id = fallback_id_match.group(1) if fallback_id_match else ""
+    if normalized_title == normalized_code:
+        if fallback_id:
+            name = name_format.replace("<STUDIOID>", fallback_id)
+        else:
+            name = name_format.replace(" [<STUDIOID>]", "")
+    else:
+        name = name_format.replace("<STUDIOID>", code)
+
+    studio = data.get('studio')
+    studio_name = studio.get('name', 'UnknownStudio') if studio else 'UnknownStudio'
+    parent = studio.get('parent_studio') if studio else None
+    parent_name = parent.get('name', studio_name) if isinstance(parent, dict) else studio_name
+
+    name = name.replace("<STUDIO>", studio_name.title())
+    name = name.replace("<PARENT>", parent_name.title())
+    name = name.replace("<TITLE>", string.capwords(title))
+    name = name.replace("<ID>", str(data.get('id', '')))
+    name = name.replace("<DATE>", data.get('date', ''))
+    name = name.replace("<PERFORMERS>", performer_str)
+    name = name.replace("<TAGS>", tags)
+    name = name.replace("<DIMENSIONS>", dimensions)
+
+    name = re.sub(r'[<>:"/\\|?*\x00-\x1F]', '', name)
+    name = re.sub(r'\s+', ' ', name).strip()
+    name = re.sub(r'[^\w\-.,()\[\]\' ]+', '', name)
+    return name
+
+
+PLACEHOLDERS = ["<STUDIOID>", "<STUDIO>", "<PARENT>", "<TITLE>", "<ID>", "<DATE>", "<PERFORMERS>", "<TAGS>", "<DIMENSIONS>"]
+
+# Deliberately awkward characters: filesystem-illegal ones, control characters, unicode letters and
+# whitespace, stray angle brackets and whole placeholders that must not be substituted a second time
+AWKWARD = list("aZ09 -_.,()[]'<>:\"/\\|?*\t\n\x01\x1c\u00a0\u2003éß中€") + PLACEHOLDERS + ["  ", "-", "_"]
+
+
+def random_text(rng, awkward, length=12):
+    if not awkward:
+        return " ".join(rng.choice(["Bench", "Scene", "title", "Big", "red", "o'neil", "2021", "part-2"]) for _ in range(rng.randint(1, 5)))
+    return "".join(rng.choice(AWKWARD) for _ in range(rng.randint(0, length)))
+
+
+def random_scene(rng, awkward):
+    text = lambda length=12: random_text(rng, awkward, length)
+    title = text(40)
+    parent = rng.choice([None, {}, {'name': text()}])
+    studio = rng.choice([None, {'id': "1", 'name': text()}, {'id': "1", 'name': text(), 'parent_studio': parent}])
+    scene = {
+        'id': str(rng.randint(1, 99999)),
+        'title': title,
+        'code': rng.choice([text(), title, title.upper() + " ", ""]) if awkward else f"BS{rng.randint(1, 99999)}",
+        'date': rng.choice(["2021-03-04", text()]),
+        'studio': studio,
+        'tags': [{'id': str(t), 'name': text()} for t in range(rng.randint(0, 12))],
+        'performers': [{'name': text()} for _ in range(rng.randint(0, 5))],
+        'files': [rng.choice([{}, {'width': 1920, 'height': 1080}, {'width': 0, 'height': 720}])],
+    }
+    for key in ['title', 'code', 'date', 'studio', 'tags', 'performers', 'files']:
+        if awkward and rng.random() < 0.05:
+            del scene[key]
+    basename = rng.choice(["bench_scene", f"bench_scene [{rng.randint(1, 9999)}]", text()])
+    return {'jsondata': scene, 'filename': basename + ".mp4", 'basename': basename}
+
+
+def random_format(rng):
+    pieces = PLACEHOLDERS + [" ", " - ", " [<STUDIOID>]", "(", ")", "[", "]", "<", ">", "x", "<DATE", "TITLE>"]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(1, 10)))
+
+
+def check_names(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import FileRenamer
+    rng = random.Random(args.seed)
+    renamer_args = argparse.Namespace(dryrun=False)
+    formats = [FileRenamer.config.name_format, "<STUDIO> - <DATE> - <TITLE> (<PERFORMERS>)", "<PARENT> <STUDIO> <ID> <TAGS>"]
+
+    # Property check: same names as the original implementation, on awkward scenes and formats
+    failures = 0
+    for i in range(args.names):
+        name_format = formats[i % len(formats)] if i % 2 else random_format(rng)
+        filedata = random_scene(rng, awkward=True)
+        FileRenamer.config.name_format = name_format
+        expected = legacy_format_filename(filedata, renamer_args, name_format, FileRenamer.truncate_string)
+        actual = FileRenamer.format_filename(filedata, renamer_args)
+        if actual != expected:
+            failures += 1
+            if failures <= 5:
+                print(f"MISMATCH for {name_format!r}:\n  scene:    {filedata!r}\n  expected: {expected!r}\n  got:      {actual!r}")
+    print(f"format_filename matched the original on {args.names - failures} of {args.names} random scenes")
+
+    # Micro-benchmark on ordinary scenes with the configured name_format
+    FileRenamer.config.name_format = formats[0]
+    scenes = [random_scene(rng, awkward=False) for _ in range(args.names)]
+    timings = {}
+    for label, formatter in [("original", lambda f: legacy_format_filename(f, renamer_args, formats[0], FileRenamer.truncate_string)),
+                             ("compiled", lambda f: FileRenamer.format_filename(f, renamer_args))]:
+        started = time.perf_counter()
+        for filedata in scenes:
+            formatter(filedata)
+        timings[label] = (time.perf_counter() - started) / max(len(scenes), 1) * 1e6
+        print(f"{label:<9} {timings[label]:8.2f} µs per name")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({'scenes': args.names, 'mismatches': failures, 'us_per_name': timings}, f, indent=2)
+    return failures == 0
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+    if args.names:
+        sys.exit(0 if check_names(args) else 1)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="filerenamer-bench-")
+    mock = MockStash(args)
+    server = mock.serve()
+    results = []
+
+    try:
+        for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+            indir = os.path.join(workdir, "in")
+            outdir = os.path.join(workdir, "out")
+            make_input_dir(indir, args.files, args.file_size)
+            shutil.rmtree(outdir, ignore_errors=True)
+            report = os.path.join(workdir, f"report-{mode}.json")
+
+            argv = ["--indir", indir, "--cache", "", "--report", report] + args.renamer_args
+            if mode == "dryrun":
+                argv.append("--dryrun")
+
+            mock.reset()
+            elapsed, peak_rss, returncode = run_renamer({
+                'port': server.server_address[1],
+                'sceneroot': os.path.join(outdir, "Scenes"),
+                'galleryroot': os.path.join(outdir, "Galleries"),
+                'argv': argv,
+            })
+            counts = mock.reset()
+
+            summary = {}
+            if os.path.exists(report):
+                with open(report, "r", encoding="utf-8") as f:
+                    summary = json.load(f).get('summary', {})
+
+            results.append({
+                'mode': mode,
+                'returncode': returncode,
+                'files': args.files,
+                'renamed': summary.get('renamed'),
+                'seconds': elapsed,
+                'files_per_sec': args.files / elapsed if elapsed else 0,
+                'graphql_requests': counts['graphql'],
+                'graphql_errors': counts['errors'],
+                'graphql_kib': counts['graphql_bytes'] / 1024,
+                'image_requests': counts['image'],
+                'images_not_modified': counts['not_modified'],
+                'requests_per_file': (counts['graphql'] + counts['image']) / args.files if args.files else 0,
+                'peak_rss_mb': peak_rss / (1024 * 1024) if peak_rss else None,
+            })
+    finally:
+        server.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'mode':<8} {'files':>7} {'renamed':>8} {'seconds':>9} {'files/s':>9} {'req/file':>9} {'graphql':>8} {'KiB':>9} {'rss MiB':>8}")
+    for r in results:
+        rss = f"{r['peak_rss_mb']:.1f}" if r['peak_rss_mb'] else "n/a"
+        print(f"{r['mode']:<8} {r['files']:>7} {str(r['renamed']):>8} {r['seconds']:>9.2f} {r['files_per_sec']:>9.1f} "
+              f"{r['requests_per_file']:>9.3f} {r['graphql_requests']:>8} {r['graphql_kib']:>9.0f} {rss:>8}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
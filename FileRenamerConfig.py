@@ -1,94 +1,144 @@
-use_https = False # Set to False for HTTP
-server_ip = "192.168.1.71"  #Don't include the '<' or '>'
-server_port = "9999" #Don't include the '<' or '>'
-username = "<USERNAME>" #Don't include the '<' or '>'
-password = "<PASSWORD>" #Don't include the '<' or '>'
-ignore_ssl_warnings = True # Set to True if your Stash uses SSL w/ a self-signed cert
-ignore_tags = ['1','2','3318','6279'] # The ID numbers of tags to not write to NFO
-
-# === Output Directories ===
-scene_root = "P:/renamed/Scenes"         # Default root for scene files
-gallery_root = "P:/renamed/Galleries"  # Default root for gallery files
-
-# === Logging ===
-logfile_path = "P:/renamed/file_renamer.log"  # Path to log file
-
-# name_format is the resulting formatting of the filename for rename
-# available options are:
-# <STUDIO>      =   The name of the scene 'Studio'
-# <PARENT>      =   The name of the 'Parent' studio.  If there is no parent,
-#                   it will be replaced by scene studio
-# <TITLE>       =   Title of the scene, as stored in Stash
-# <DATE>        =   Date of the scene, as stoed in Stash (will be YYY-MM-DD format)
-# <ID>          =   Internal Stash ID of scene
-# <TAGS>        =   The associated tag names, will be separated by ", "
-# <PERFORMERS>  =   Names of associated performers, separated by ", " and surrounded by ().  Ie. (Mia Malkova, Keisha Grey)
-# <DIMENSION>   =   Dimensions of the video in '[WIDTHxHEIGHT]' format.  Ie. [1920x1080]
-# <STUDIOID>    =   Studio ID / Studio Code for scene as pulled from Stashdb or TPDB
-# ~ name_format = "<STUDIO> - <DATE> - <TITLE> (<PERFORMERS>)"
-name_format = "<STUDIO> <DATE> <TITLE> <PERFORMERS> [<STUDIOID>] <DIMENSIONS>"
-create_parental_path = True # If true, a directory structure will be created that includes
-                            # subdirectories for all parental studios.  File will be
-                            # moved to lowest level.
-                            # If False, the file will not be moved from current directory
-
-create_collection_tags = True # this one is strange, admittedly.  Stash 'Tags' are stored in the
-                              # NFO 'Genres' instead.  However Plex allows you to use smart
-                              # collections based on tags, so by default this will create tags
-                              # based on the site and parent studio, such as "Site: SiteName"
-                              # and "Studio: StudioName".  Set this to False to disable creation
-                              # of these tags.
-headers = {}
-api_key = ""
-
-file_query = """
-    query {
-      findScenes(
-        scene_filter: { path: { value:
-          "\\"<FILENAME>\\"",
-          modifier: INCLUDES } }
-      ) {
-        scenes {
-          id
-          title
-          details
-          code
-          url
-          date
-          rating100
-          paths{
-            screenshot
-            stream
-          }
-          studio{
-            id
-            name
-            image_path
-            parent_studio{
-              id
-              name
-              details
-            }
-          }
-          tags{
-            id
-            name
-          }
-          performers{
-            name
-            image_path
-          }
-          movies{
-            movie{
-              name
-            }
-          }
-          files{
-            width
-            height
-            path
-          }
-        }
-      }
-    }
-"""
+use_https = False # Set to False for HTTP
+server_ip = "192.168.1.71"  #Don't include the '<' or '>'
+server_port = "9999" #Don't include the '<' or '>'
+username = "<USERNAME>" #Don't include the '<' or '>'
+password = "<PASSWORD>" #Don't include the '<' or '>'
+ignore_ssl_warnings = True # Set to True if your Stash uses SSL w/ a self-signed cert
+ignore_tags = ['1','2','3318','6279'] # The ID numbers of tags to not write to NFO
+
+# === Network ===
+http_pool_size = 10          # Max keep-alive connections held open to the Stash server
+http_connect_timeout = 10    # Seconds to wait for a connection to be established
+http_read_timeout = 60       # Seconds to wait for the server to answer a request
+preload_studios = True       # Load the whole studio tree once at startup instead of one query per studio level
+studio_page_size = 500       # Studios fetched per request when preloading the studio tree
+batch_size = 50              # Files looked up per GraphQL request (1 = one request per file)
+graphql_retries = 5          # Retries for a GraphQL request that timed out or got a 5xx/429 answer
+graphql_backoff_base = 0.5   # Seconds; retry delays are random up to base * 2^attempt
+graphql_backoff_max = 30     # Longest wait between retries, also caps the server's Retry-After
+graphql_max_concurrency = 8  # Most GraphQL requests in flight at once; lowered automatically while Stash is slow
+graphql_min_concurrency = 1  # ...but never below this
+graphql_target_latency = 2.0 # Seconds; slower answers count as Stash being busy
+shape_queries = True         # Fetch only the scene fields name_format (and --extra) use; False sends file_query's field list as is
+workers = 4                  # Threads doing Stash lookups (workers = io_workers = 1 processes files one at a time)
+io_workers = 2               # Threads doing moves, screenshot downloads and NFO writes
+cache_path = "file_renamer_cache.sqlite"  # Local cache of Stash lookups, reused between runs ("" to disable)
+cache_ttl_hours = 168        # Cached lookups older than this are fetched again (0 = never expire)
+scene_index_path = "file_renamer_index.json"  # Scene filename index used by --index, updated incrementally each run
+index_page_size = 1000       # Scenes fetched per request while building the scene index
+match_mode = "filename"      # "filename" searches Stash by file name, "oshash" by the file's oshash fingerprint
+hash_workers = 4             # Processes computing oshash fingerprints in --match=oshash mode
+scan_queue_size = 1000       # Scanned files allowed to wait for processing before the directory scan pauses
+copies_per_device = 1        # Concurrent cross-device copies allowed into the same target drive
+copy_buffer_size = 64 * 1024 * 1024       # Bytes per copy call when moving between drives
+copy_progress_bytes = 1024 * 1024 * 1024  # Log copy progress (verbose only) every this many bytes, 0 to disable
+conditional_screenshots = True  # --extra: ask Stash whether a screenshot already on disk changed (304) before downloading it
+journal_path = "file_renamer_journal.jsonl"  # Progress journal for --resume, removed when a run finishes.  Gets a suffix per --indir/--shard/--apply ("" to disable)
+journal_sync_every = 200     # Journal lines written between fsyncs
+journal_sync_seconds = 2     # ...or seconds, whichever comes first
+watch_settle_seconds = 10    # --watch: a file must stop changing for this long before it is processed
+watch_poll_seconds = 30      # --watch: rescan interval where inotify isn't available (e.g. Windows)
+watch_retry_seconds = 60     # --watch: first retry delay for files Stash hasn't scanned yet or that failed, doubled each attempt
+watch_retry_max_seconds = 3600  # --watch: longest delay between retries
+watch_retry_attempts = 8     # --watch: retries before giving up on a file
+dir_locks = False            # Lock target directories with a lock file (always on with --shard) when several machines share them
+dir_lock_timeout = 60        # Seconds to wait for another machine's directory lock
+dir_lock_stale_seconds = 300 # Lock files, and empty placeholder targets, older than this are assumed to be left over from a crash
+case_insensitive_targets = False  # Treat target names differing only in case as taken (for Windows/SMB clients of a Linux share)
+duplicate_action = ""         # "quarantine" or "delete" incoming files already in the library (same size and sampled hash), "" to just skip taken names
+duplicate_quarantine = "P:/renamed/Duplicates"  # Where quarantined duplicates are moved
+duplicate_suffix = " (<N>)"   # With duplicate_action set, a different file under a taken name is moved with this suffix (<N> counts from 2)
+duplicate_sample_bytes = 1024 * 1024  # Bytes hashed from the start and the end of each file to recognise duplicates
+library_index_path = "file_renamer_library.json"  # Sizes and sampled hashes of the files under the roots, kept between runs ("" to rehash every run)
+library_rescan_hours = 24     # Walk the whole library again after this long; in between only the directories moved into are re-read (0 = every run)
+
+# === Output Directories ===
+scene_root = "P:/renamed/Scenes"         # Default root for scene files
+gallery_root = "P:/renamed/Galleries"  # Default root for gallery files
+
+# === Logging ===
+logfile_path = "P:/renamed/file_renamer.log"  # Path to log file
+log_flush_seconds = 2  # The log file is written in batches, at least this often
+audit_log_path = ""    # JSON lines of every file moved or sidecar written, usable with --undo ("" to disable)
+
+# name_format is the resulting formatting of the filename for rename
+# available options are:
+# <STUDIO>      =   The name of the scene 'Studio'
+# <PARENT>      =   The name of the 'Parent' studio.  If there is no parent,
+#                   it will be replaced by scene studio
+# <TITLE>       =   Title of the scene, as stored in Stash
+# <DATE>        =   Date of the scene, as stoed in Stash (will be YYY-MM-DD format)
+# <ID>          =   Internal Stash ID of scene
+# <TAGS>        =   The associated tag names, will be separated by ", "
+# <PERFORMERS>  =   Names of associated performers, separated by ", " and surrounded by ().  Ie. (Mia Malkova, Keisha Grey)
+# <DIMENSION>   =   Dimensions of the video in '[WIDTHxHEIGHT]' format.  Ie. [1920x1080]
+# <STUDIOID>    =   Studio ID / Studio Code for scene as pulled from Stashdb or TPDB
+# ~ name_format = "<STUDIO> - <DATE> - <TITLE> (<PERFORMERS>)"
+name_format = "<STUDIO> <DATE> <TITLE> <PERFORMERS> [<STUDIOID>] <DIMENSIONS>"
+create_parental_path = True # If true, a directory structure will be created that includes
+                            # subdirectories for all parental studios.  File will be
+                            # moved to lowest level.
+                            # If False, the file will not be moved from current directory
+
+create_collection_tags = True # this one is strange, admittedly.  Stash 'Tags' are stored in the
+                              # NFO 'Genres' instead.  However Plex allows you to use smart
+                              # collections based on tags, so by default this will create tags
+                              # based on the site and parent studio, such as "Site: SiteName"
+                              # and "Studio: StudioName".  Set this to False to disable creation
+                              # of these tags.
+headers = {}
+api_key = ""  # Stash API key (Settings > Security); when set, no login or /playground probe is needed
+auth_cache_path = "~/.config/file_renamer/auth.json"  # Remembers how to authenticate (and the login session) between runs, per user ("" to disable)
+auth_cache_hours = 24         # Work out authentication again after this long, or as soon as Stash answers 401
+
+file_query = """
+    query {
+      findScenes(
+        scene_filter: { path: { value:
+          "\\"<FILENAME>\\"",
+          modifier: INCLUDES } }
+      ) {
+        scenes {
+          id
+          title
+          details
+          code
+          url
+          date
+          rating100
+          paths{
+            screenshot
+            stream
+          }
+          studio{
+            id
+            name
+            image_path
+            parent_studio{
+              id
+              name
+              details
+            }
+          }
+          tags{
+            id
+            name
+          }
+          performers{
+            name
+            image_path
+          }
+          movies{
+            movie{
+              name
+            }
+          }
+          files{
+            width
+            height
+            path
+          }
+        }
+      }
+    }
+"""